@@ -1,9 +1,9 @@
 """Add food data to existing database"""
-from database import SessionLocal, engine
+from database import SessionLocal, init_schema
 import models
 
 # Create new tables if they don't exist
-models.Base.metadata.create_all(bind=engine)
+init_schema()
 
 db = SessionLocal()
 
@@ -0,0 +1,202 @@
+"""Cohort analytics served from a columnar snapshot.
+
+Every ANALYTICS_REFRESH_INTERVAL seconds the OLTP tables (`users`,
+`user_weekly_data`, `challenge_completions`, `activity_logs`, plus archived
+months) are copied into NumPy arrays once. Percentiles, percent changes,
+category breakdowns and cohort averages are then computed with vectorized
+operations on that snapshot, so `/api/analytics/...` requests never query
+the live tables.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+import archive
+import models
+
+ANALYTICS_REFRESH_INTERVAL = float(os.getenv("ANALYTICS_REFRESH_INTERVAL", "300"))  # seconds
+RECENT_WEEKS = 4
+PERCENTILES = [10, 25, 50, 75, 90]
+
+
+def percent_change(recent: float, previous: float) -> float:
+    return round((recent - previous) / previous * 100, 1) if previous else 0.0
+
+
+class Snapshot:
+    """Immutable columnar copy of the data behind the analytics endpoints"""
+
+    def __init__(self, db):
+        self.built_at = datetime.utcnow()
+
+        users = db.query(models.User.id, models.User.created_at).order_by(models.User.id).all()
+        self.user_ids = np.array([u[0] for u in users], dtype=np.int64)
+        cohorts = np.array([u[1].strftime("%Y-%m") if u[1] else "unknown" for u in users])
+        self.cohort_names, self.user_cohort = np.unique(cohorts, return_inverse=True) if len(users) else (np.array([]), np.array([], dtype=np.int64))
+
+        # ---- weekly data: per-user recent vs previous footprint, total saved ----
+        weekly = db.query(
+            models.UserWeeklyData.user_id, models.UserWeeklyData.id,
+            models.UserWeeklyData.footprint, models.UserWeeklyData.saved
+        ).all()
+        w_user = self._user_index(np.array([w[0] for w in weekly], dtype=np.int64))
+        w_id = np.array([w[1] for w in weekly], dtype=np.int64)
+        w_footprint = np.array([w[2] or 0 for w in weekly], dtype=np.float64)
+        w_saved = np.array([w[3] or 0 for w in weekly], dtype=np.float64)
+        valid = w_user >= 0
+        w_user, w_id, w_footprint, w_saved = w_user[valid], w_id[valid], w_footprint[valid], w_saved[valid]
+
+        n = len(self.user_ids)
+        self.total_saved = np.bincount(w_user, weights=w_saved, minlength=n)
+        # Position of each week counted back from the user's latest week (0 = latest)
+        order = np.lexsort((-w_id, w_user))
+        sorted_users = w_user[order]
+        first = np.searchsorted(sorted_users, sorted_users, side="left")
+        age = np.empty_like(order)
+        age[order] = np.arange(len(order)) - first
+        recent = age < RECENT_WEEKS
+        previous = (age >= RECENT_WEEKS) & (age < 2 * RECENT_WEEKS)
+        self.recent_footprint = np.bincount(w_user[recent], weights=w_footprint[recent], minlength=n)
+        self.previous_footprint = np.bincount(w_user[previous], weights=w_footprint[previous], minlength=n)
+
+        # ---- challenge completions (hot + archived) ----
+        c_user, c_saved = [], []
+        for user_id, co2 in db.query(models.ChallengeCompletion.user_id, models.ChallengeCompletion.co2_saved):
+            c_user.append(user_id)
+            c_saved.append(co2 or 0)
+        for row in archive.archived_rows_desc("challenge_completions"):
+            c_user.append(row["user_id"])
+            c_saved.append(row["co2_saved"] or 0)
+        c_index = self._user_index(np.array(c_user, dtype=np.int64))
+        c_valid = c_index >= 0
+        self.completions = np.bincount(c_index[c_valid], minlength=n)
+        self.completion_saved = np.bincount(c_index[c_valid], weights=np.array(c_saved, dtype=np.float64)[c_valid], minlength=n)
+
+        # ---- activity logs by food category (hot + archived) ----
+        categories = {f.id: f.category for f in db.query(models.Food.id, models.Food.category)}
+        labels, impact = [], []
+        for food_id, recipe_id, co2 in db.query(
+            models.ActivityLog.food_id, models.ActivityLog.recipe_id, models.ActivityLog.co2_impact
+        ):
+            labels.append("Recipe" if recipe_id is not None else categories.get(food_id, "Unknown"))
+            impact.append(co2 or 0)
+        for row in archive.archived_rows_desc("activity_logs"):
+            labels.append("Recipe" if row.get("recipe_id") is not None else categories.get(row["food_id"], "Unknown"))
+            impact.append(row["co2_impact"] or 0)
+        if labels:
+            self.category_names, category_index = np.unique(np.array(labels), return_inverse=True)
+            self.category_co2 = np.bincount(category_index, weights=np.array(impact, dtype=np.float64))
+            self.category_count = np.bincount(category_index)
+        else:
+            self.category_names = np.array([])
+            self.category_co2 = self.category_count = np.array([])
+
+        self._sorted_saved = np.sort(self.total_saved)
+
+    def _user_index(self, user_ids):
+        """Map user ids to row positions in the snapshot (-1 if unknown)"""
+        if not len(self.user_ids):
+            return np.full(len(user_ids), -1, dtype=np.int64)
+        pos = np.searchsorted(self.user_ids, user_ids)
+        pos = np.clip(pos, 0, len(self.user_ids) - 1)
+        return np.where(self.user_ids[pos] == user_ids, pos, -1)
+
+    # ---- queries ----
+
+    def overview(self) -> dict:
+        n = len(self.user_ids)
+        return {
+            "users": int(n),
+            "percentChange": percent_change(self.recent_footprint.sum(), self.previous_footprint.sum()),
+            "savedPercentiles": dict(zip(map(str, PERCENTILES), np.percentile(self.total_saved, PERCENTILES).round(1).tolist())) if n else {},
+            "completionPercentiles": dict(zip(map(str, PERCENTILES), np.percentile(self.completions, PERCENTILES).round(1).tolist())) if n else {},
+            "averageSaved": round(float(self.total_saved.mean()), 1) if n else 0,
+            "snapshotAt": self.built_at.isoformat(),
+        }
+
+    def user(self, user_id: int):
+        i = int(self._user_index(np.array([user_id], dtype=np.int64))[0])
+        if i < 0:
+            return None
+        cohort = self.user_cohort == self.user_cohort[i]
+        below = np.searchsorted(self._sorted_saved, self.total_saved[i], side="left")
+        return {
+            "totalSaved": float(self.total_saved[i]),
+            "completions": int(self.completions[i]),
+            "percentChange": percent_change(self.recent_footprint[i], self.previous_footprint[i]),
+            "savedPercentile": round(below / len(self.user_ids) * 100, 1),
+            "cohort": str(self.cohort_names[self.user_cohort[i]]),
+            "cohortAverageSaved": round(float(self.total_saved[cohort].mean()), 1),
+            "cohortAverageCompletions": round(float(self.completions[cohort].mean()), 1),
+            "snapshotAt": self.built_at.isoformat(),
+        }
+
+    def categories(self) -> list:
+        total = self.category_co2.sum()
+        order = np.argsort(-self.category_co2)
+        return [
+            {
+                "category": str(self.category_names[i]),
+                "co2": round(float(self.category_co2[i]), 2),
+                "logs": int(self.category_count[i]),
+                "share": round(float(self.category_co2[i] / total * 100), 1) if total else 0,
+            }
+            for i in order
+        ]
+
+    def cohorts(self) -> list:
+        n_cohorts = len(self.cohort_names)
+        sizes = np.bincount(self.user_cohort, minlength=n_cohorts)
+        saved = np.bincount(self.user_cohort, weights=self.total_saved, minlength=n_cohorts)
+        completions = np.bincount(self.user_cohort, weights=self.completions, minlength=n_cohorts)
+        return [
+            {
+                "cohort": str(self.cohort_names[c]),
+                "users": int(sizes[c]),
+                "averageSaved": round(float(saved[c] / sizes[c]), 1),
+                "averageCompletions": round(float(completions[c] / sizes[c]), 1),
+            }
+            for c in range(n_cohorts) if sizes[c]
+        ]
+
+
+class SnapshotStore:
+    """Holds the latest snapshot and rebuilds it in the background"""
+
+    def __init__(self, session_factory, interval=ANALYTICS_REFRESH_INTERVAL):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.snapshot = None
+        self._build_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def refresh(self) -> Snapshot:
+        with self._build_lock:
+            db = self.session_factory()
+            try:
+                self.snapshot = Snapshot(db)
+            finally:
+                db.close()
+        return self.snapshot
+
+    def get(self) -> Snapshot:
+        """Latest snapshot, building the first one on demand"""
+        return self.snapshot or self.refresh()
+
+    def start(self):
+        threading.Thread(target=self._run, name="analytics", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Analytics snapshot failed: {e}")
+            self._stop.wait(max(0.0, self.interval - (time.monotonic() - started)))
@@ -0,0 +1,297 @@
+"""Monthly archival for the append-only event tables.
+
+`activity_logs` and `challenge_completions` are partitioned by month on their
+timestamp column. Months older than ARCHIVE_HOT_MONTHS are moved out of the
+database into compressed columnar files (archive/<table>/<YYYY-MM>.json.gz,
+one list per column), so the hot tables only hold recent events. History and
+export queries read hot rows first and fall back to archived months. Next to
+each file is an index of the users it holds (<YYYY-MM>.users.json), so one
+user's history only opens the months that user has rows in.
+
+Run once from the command line with `python archive.py`, or set
+ARCHIVE_ENABLED=1 to archive on a schedule from the server.
+"""
+import fcntl
+import gzip
+import json
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+
+import models
+
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "0") == "1"
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")
+ARCHIVE_HOT_MONTHS = int(os.getenv("ARCHIVE_HOT_MONTHS", "3"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "86400"))  # seconds
+
+# table -> (model, partition column, columns stored in the archive)
+PARTITIONED = {
+    "activity_logs": (models.ActivityLog, "logged_at",
+                      ["id", "food_id", "recipe_id", "user_id", "quantity_grams", "co2_impact", "factor_version", "logged_at"]),
+    "challenge_completions": (models.ChallengeCompletion, "completed_at",
+                              ["id", "user_id", "challenge_id", "completed_at", "co2_saved"]),
+}
+
+
+# ============ MONTH HELPERS ============
+
+def month_key(value) -> str:
+    """'YYYY-MM' for a datetime or ISO string"""
+    return value.strftime("%Y-%m") if isinstance(value, datetime) else value[:7]
+
+def month_bounds(month: str):
+    year, mon = int(month[:4]), int(month[5:7])
+    start = datetime(year, mon, 1)
+    end = datetime(year + mon // 12, mon % 12 + 1, 1)
+    return start, end
+
+def cutoff_month(now=None, hot_months=ARCHIVE_HOT_MONTHS) -> str:
+    """First month that stays hot"""
+    now = now or datetime.utcnow()
+    index = now.year * 12 + now.month - 1 - (hot_months - 1)
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+# ============ ARCHIVE FILES ============
+
+def partition_path(table: str, month: str) -> str:
+    return os.path.join(ARCHIVE_DIR, table, f"{month}.json.gz")
+
+def archived_months(table: str) -> list:
+    directory = os.path.join(ARCHIVE_DIR, table)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(f[:7] for f in os.listdir(directory) if f.endswith(".json.gz"))
+
+def _read_columns(path: str) -> dict:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+@lru_cache(maxsize=32)
+def _load_partition(path: str, mtime: float) -> tuple:
+    columns = _read_columns(path)
+    names = list(columns)
+    return tuple(dict(zip(names, values)) for values in zip(*columns.values()))
+
+def load_partition(table: str, month: str) -> tuple:
+    """Rows of an archived month, oldest first (cached until the file changes)"""
+    path = partition_path(table, month)
+    try:
+        return _load_partition(path, os.path.getmtime(path))
+    except FileNotFoundError:
+        return ()
+
+def users_path(table: str, month: str) -> str:
+    return os.path.join(ARCHIVE_DIR, table, f"{month}.users.json")
+
+@lru_cache(maxsize=256)
+def _users_from_partition(path: str, mtime: float) -> frozenset:
+    return frozenset(user_id for user_id in _read_columns(path).get("user_id", []) if user_id is not None)
+
+@lru_cache(maxsize=256)
+def _load_users(path: str, mtime: float) -> frozenset:
+    with open(path, encoding="utf-8") as f:
+        return frozenset(json.load(f))
+
+def partition_users(table: str, month: str) -> frozenset:
+    """User ids with rows in an archived month"""
+    path = partition_path(table, month)
+    index = users_path(table, month)
+    try:
+        mtime = os.path.getmtime(path)
+    except FileNotFoundError:
+        return frozenset()
+    try:
+        index_mtime = os.path.getmtime(index)
+        if index_mtime >= mtime:
+            return _load_users(index, index_mtime)
+    except FileNotFoundError:
+        pass
+    # No index yet (archived before indexes existed, or mid-write)
+    return _users_from_partition(path, mtime)
+
+def write_users(table: str, month: str):
+    """Write the user index for a month from its archive file"""
+    partition = partition_path(table, month)
+    users = _users_from_partition(partition, os.path.getmtime(partition))
+    path = users_path(table, month)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(sorted(users), f)
+    os.replace(tmp_path, path)
+
+def write_partition(table: str, month: str, rows: list, path=None):
+    """Merge rows into a month's archive file, de-duplicated by id.
+
+    With `path` the merged file is written there instead, for
+    install_partition to move into place later.
+    """
+    _, column, names = PARTITIONED[table]
+    merged = {row["id"]: row for row in load_partition(table, month)}
+    merged.update((row["id"], row) for row in rows)
+    ordered = sorted(merged.values(), key=lambda r: (r[column], r["id"]))
+
+    target = path or partition_path(table, month)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = target + ".tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        # .get: files written before a column was added don't have it
+        json.dump({name: [row.get(name) for row in ordered] for name in names}, f, separators=(",", ":"))
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, target)
+    if path is None:
+        write_users(table, month)
+
+def install_partition(table: str, month: str, path: str):
+    """Replace a month's archive file with one staged by write_partition"""
+    os.replace(path, partition_path(table, month))
+    write_users(table, month)
+
+@contextmanager
+def archive_lock(blocking: bool = True):
+    """Exclusive lock for rewriting archive files; yields False if not blocking and taken"""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    with open(os.path.join(ARCHIVE_DIR, ".lock"), "w") as lock:
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            yield False
+            return
+        yield True
+
+
+# ============ ARCHIVAL ============
+
+def _serialize(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def hot_months(db, table: str) -> list:
+    model, column, _ = PARTITIONED[table]
+    col = getattr(model, column)
+    months = set()
+    oldest = db.query(col).order_by(col).first()
+    # Walk month by month using the index on the partition column
+    while oldest and oldest[0] is not None:
+        month = month_key(oldest[0])
+        months.add(month)
+        _, end = month_bounds(month)
+        bound = end if isinstance(oldest[0], datetime) else end.isoformat()
+        oldest = db.query(col).filter(col >= bound).order_by(col).first()
+    return sorted(months)
+
+def archive_month(db, table: str, month: str) -> int:
+    """Move one month of a hot table into its archive file"""
+    model, column, names = PARTITIONED[table]
+    col = getattr(model, column)
+    start, end = month_bounds(month)
+    if column == "logged_at":
+        start, end = start.isoformat(), end.isoformat()
+    query = db.query(model).filter(col >= start, col < end)
+    rows = [{name: _serialize(getattr(obj, name)) for name in names} for obj in query.all()]
+    if not rows:
+        return 0
+    write_partition(table, month, rows)
+    query.delete(synchronize_session=False)
+    db.commit()
+    return len(rows)
+
+def run_archival(db, now=None) -> list:
+    """Archive every month older than the hot window; returns (table, month, rows)"""
+    cutoff = cutoff_month(now)
+    archived = []
+    for table in PARTITIONED:
+        for month in archived_months(table):
+            if not os.path.exists(users_path(table, month)):
+                write_users(table, month)
+        for month in hot_months(db, table):
+            if month < cutoff:
+                archived.append((table, month, archive_month(db, table, month)))
+    return archived
+
+
+# ============ READS (HOT + ARCHIVE) ============
+
+def archived_rows_desc(table: str, predicate=None):
+    """Archived rows newest first, loading one month file at a time"""
+    for month in reversed(archived_months(table)):
+        for row in reversed(load_partition(table, month)):
+            if predicate is None or predicate(row):
+                yield row
+
+def archived_completions_desc(user_id: int):
+    """A user's archived challenge completions newest first, skipping months without any"""
+    for month in reversed(archived_months("challenge_completions")):
+        if user_id not in partition_users("challenge_completions", month):
+            continue
+        for row in reversed(load_partition("challenge_completions", month)):
+            if row["user_id"] == user_id:
+                yield {**row, "completed_at": datetime.fromisoformat(row["completed_at"])}
+
+def completions_desc(db, user_id: int, archived: bool = True):
+    """A user's challenge completions newest first, hot then (optionally) archived"""
+    hot = db.query(models.ChallengeCompletion).filter(
+        models.ChallengeCompletion.user_id == user_id
+    ).order_by(models.ChallengeCompletion.completed_at.desc()).yield_per(100)
+    for c in hot:
+        yield {"id": c.id, "challenge_id": c.challenge_id, "co2_saved": c.co2_saved, "completed_at": c.completed_at}
+    if archived:
+        yield from archived_completions_desc(user_id)
+
+def activity_logs_desc(db):
+    """Activity logs newest first, hot then archived"""
+    hot = db.query(models.ActivityLog).order_by(models.ActivityLog.id.desc()).yield_per(100)
+    for log in hot:
+        yield {"id": log.id, "food_id": log.food_id, "recipe_id": log.recipe_id, "user_id": log.user_id,
+               "quantity_grams": log.quantity_grams, "co2_impact": log.co2_impact,
+               "factor_version": log.factor_version, "logged_at": log.logged_at}
+    yield from archived_rows_desc("activity_logs")
+
+
+# ============ SCHEDULER ============
+
+class Archiver:
+    """Runs archival periodically; a lock file keeps it to one process"""
+
+    def __init__(self, session_factory, interval=ARCHIVE_INTERVAL):
+        self.session_factory = session_factory
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="archiver", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self) -> list:
+        with archive_lock(blocking=False) as locked:
+            if not locked:
+                return []  # another worker is archiving
+            db = self.session_factory()
+            try:
+                return run_archival(db)
+            finally:
+                db.close()
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Archival failed: {e}")
+            if self._stop.wait(self.interval):
+                break
+
+
+if __name__ == "__main__":
+    from database import SessionLocal, init_schema
+
+    init_schema()
+    for table, month, count in Archiver(SessionLocal).run_once():
+        print(f"Archived {count} rows from {table} for {month}")
@@ -0,0 +1,126 @@
+"""Change log for delta sync.
+
+Every insert, update or delete of a synced row (the food and recipe catalog,
+and each user's weekly data, badges, completions and logged activity) is
+recorded in `change_log` by mapper events, in the same transaction.
+Each row keeps only its latest change: recording a change replaces the
+previous entry for that key under a new, higher version. The log is therefore
+compacted per key and never grows past one entry per row ever synced.
+
+`/api/sync?since=<version>` is an indexed range scan over (scope, version).
+SQLite runs one write transaction at a time, so versions become visible in
+order and a client never skips a change by resuming from the last version it
+saw.
+"""
+import json
+from datetime import datetime
+
+from sqlalchemy import event, inspect, text
+
+import models
+
+# model -> owning user column (None for catalog tables)
+SYNCED = {
+    models.Food: None,
+    models.Recipe: None,
+    models.RecipeIngredient: None,
+    models.UserWeeklyData: "user_id",
+    models.UserBadge: "user_id",
+    models.ChallengeCompletion: "user_id",
+    models.ActivityLog: "user_id",
+}
+MAX_PAGE = 1000
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+def scope_for(owner_column, row: dict):
+    """Sync scope of a row, or None for rows nobody syncs (anonymous activity)"""
+    if owner_column is None:
+        return "catalog"
+    owner = row.get(owner_column)
+    return f"user:{owner}" if owner is not None else None
+
+
+# ============ RECORDING ============
+
+def record(connection, entity: str, changes):
+    """Record (scope, key, op, row) changes for one table, replacing older entries per key"""
+    now = datetime.utcnow()
+    rows = [
+        {"scope": scope, "entity": entity, "key": str(key), "op": op,
+         "data": json.dumps(row, default=_json_default) if op == "upsert" else None, "changed_at": now}
+        for scope, key, op, row in changes if scope is not None
+    ]
+    if rows:
+        connection.execute(text(
+            "INSERT OR REPLACE INTO change_log (scope, entity, key, op, data, changed_at) "
+            "VALUES (:scope, :entity, :key, :op, :data, :changed_at)"
+        ), rows)
+
+def _row(obj) -> dict:
+    return {attr.key: getattr(obj, attr.key) for attr in inspect(obj).mapper.column_attrs}
+
+def _record_object(connection, target, op: str):
+    row = _row(target)
+    key = inspect(target).mapper.primary_key_from_instance(target)[0]
+    record(connection, type(target).__tablename__, [(scope_for(SYNCED[type(target)], row), key, op, row)])
+
+# Mapper events rather than after_flush so cascaded deletes (orphaned recipe
+# ingredients) are seen too
+def _after_insert(mapper, connection, target):
+    _record_object(connection, target, "upsert")
+
+def _after_update(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[attr.key].history.has_changes() for attr in mapper.column_attrs):
+        _record_object(connection, target, "upsert")
+
+def _after_delete(mapper, connection, target):
+    _record_object(connection, target, "delete")
+
+for _model in SYNCED:
+    event.listen(_model, "after_insert", _after_insert)
+    event.listen(_model, "after_update", _after_update)
+    event.listen(_model, "after_delete", _after_delete)
+
+def backfill(connection) -> int:
+    """Record every existing synced row, so a first sync (since=0) returns the full dataset"""
+    total = 0
+    for model, owner_column in SYNCED.items():
+        table = model.__table__
+        key_column = table.primary_key.columns.values()[0].name
+        changes = []
+        for result in connection.execute(table.select()):
+            row = dict(result._mapping)
+            changes.append((scope_for(owner_column, row), row[key_column], "upsert", row))
+        record(connection, table.name, changes)
+        total += len(changes)
+    return total
+
+
+# ============ READING ============
+
+def changes_since(db, since: int, user_id=None, limit: int = 500) -> dict:
+    """One page of changes after `since` visible to a user (or only the catalog)"""
+    limit = max(1, min(limit, MAX_PAGE))
+    scopes = ["catalog"] + ([f"user:{user_id}"] if user_id is not None else [])
+    log = models.ChangeLog
+    query = db.query(log).filter(log.scope.in_(scopes), log.version > since)
+    if since == 0:
+        # A fresh client has nothing to delete
+        query = query.filter(log.op == "upsert")
+    rows = query.order_by(log.version).limit(limit + 1).all()
+    page = rows[:limit]
+    return {
+        "changes": [
+            {"version": r.version, "entity": r.entity, "key": r.key, "op": r.op,
+             "data": json.loads(r.data) if r.data is not None else None}
+            for r in page
+        ],
+        "version": page[-1].version if page else since,
+        "has_more": len(rows) > limit,
+    }
@@ -1,12 +1,130 @@
-from sqlalchemy import create_engine
+import os
+import sqlite3
+import time
+import uuid
+
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
+# Read-only endpoints use READ_DATABASE_URL (e.g. a PostgreSQL replica) when
+# set, otherwise read-only connections to the same SQLite file, which WAL lets
+# run alongside the writer without taking its lock
+READ_DATABASE_URL = os.getenv("READ_DATABASE_URL", "")
+REPLICA_RETRY_SECONDS = float(os.getenv("REPLICA_RETRY_SECONDS", "30"))
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+WriteSessionLocal = SessionLocal
+
+read_engine = create_engine(
+    READ_DATABASE_URL or "sqlite:///file:./sql_app.db?mode=ro&uri=true",
+    **({"connect_args": {"check_same_thread": False}} if not READ_DATABASE_URL or READ_DATABASE_URL.startswith("sqlite") else {})
+)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
 
 Base = declarative_base()
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run alongside the writer; busy_timeout makes writers
+    # from other worker processes wait for the lock instead of failing
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+# Every transaction that changed rows bumps db_meta.generation as it commits,
+# so snapshot restore can tell which copy of a database is further ahead
+@event.listens_for(engine, "begin")
+def remember_changes(conn):
+    conn.info["changes_at_begin"] = conn.connection.dbapi_connection.total_changes
+
+@event.listens_for(engine, "commit")
+def bump_generation(conn):
+    dbapi_connection = conn.connection.dbapi_connection
+    if dbapi_connection.total_changes == conn.info.get("changes_at_begin"):
+        return
+    try:
+        dbapi_connection.execute("UPDATE db_meta SET generation = generation + 1")
+    except sqlite3.OperationalError:
+        pass  # no db_meta yet (before init_schema)
+
+@event.listens_for(read_engine, "connect")
+def set_read_pragmas(dbapi_connection, connection_record):
+    if read_engine.dialect.name == "sqlite":
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.execute("PRAGMA query_only=1")
+        cursor.close()
+
+_replica_down_until = 0.0
+
+def read_session():
+    """Session on the read engine, or on the primary while the replica is unreachable"""
+    global _replica_down_until
+    if time.monotonic() >= _replica_down_until:
+        db = ReadSessionLocal()
+        try:
+            db.connection()
+            return db
+        except OperationalError as e:
+            db.close()
+            _replica_down_until = time.monotonic() + REPLICA_RETRY_SECONDS
+            print(f"Read replica unavailable, reading from primary: {e}")
+    return SessionLocal()
+
+def missing_columns():
+    """(table, column) pairs defined on models but absent from existing tables"""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        missing.extend((table, column) for column in table.columns if column.name not in existing)
+    return missing
+
+def init_schema():
+    """Create missing tables, columns and indexes. Run once before worker processes start."""
+    import models  # noqa: F401 - registers tables on Base
+    # Registers the write hooks that keep derived tables current (for seed scripts)
+    import change_log
+    import teams
+    existing_tables = set(inspect(engine).get_table_names())
+    Base.metadata.create_all(bind=engine)
+    # create_all skips columns added to tables that already exist
+    with engine.begin() as conn:
+        for table, column in missing_columns():
+            column_type = column.type.compile(dialect=engine.dialect)
+            conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}'))
+    # create_all skips indexes added to tables that already exist
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT OR IGNORE INTO db_meta (id, lineage, generation) VALUES (1, :lineage, 0)"),
+                     {"lineage": uuid.uuid4().hex})
+    # Backfill derived tables from rows recorded before they existed
+    created = set(Base.metadata.tables) - existing_tables
+    if created & {"impact_rollups", "change_log", "emission_factors"}:
+        import recompute
+        with engine.begin() as conn:
+            if "emission_factors" in created:
+                recompute.backfill_versions(conn)
+            if "impact_rollups" in created:
+                teams.rebuild(conn)
+            if "change_log" in created:
+                change_log.backfill(conn)
+
+def schema_is_current() -> bool:
+    """Cheap check that every model table and column exists"""
+    import models  # noqa: F401
+    if not set(Base.metadata.tables) <= set(inspect(engine).get_table_names()):
+        return False
+    return not missing_columns()
@@ -0,0 +1,120 @@
+"""In-process pub/sub feeding the `/api/user/stream` server-sent events endpoint.
+
+Handlers publish small deltas (summary totals, chart week, activity rows) after
+a write; each connected client holds an asyncio queue on the server's loop.
+`publish` is thread-safe so sync endpoints and the write-behind worker can use it.
+"""
+import asyncio
+import itertools
+import json
+import os
+import threading
+
+SSE_MAX_CONNECTIONS = int(os.getenv("SSE_MAX_CONNECTIONS", "500"))
+SSE_MAX_PER_USER = int(os.getenv("SSE_MAX_PER_USER", "5"))
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", "15"))  # seconds
+SSE_QUEUE_SIZE = 100
+
+
+class TooManyConnections(Exception):
+    """Raised when a stream would exceed the global or per-user limit"""
+
+
+class EventBroker:
+    def __init__(self, max_connections=SSE_MAX_CONNECTIONS, max_per_user=SSE_MAX_PER_USER):
+        self.max_connections = max_connections
+        self.max_per_user = max_per_user
+        self._subscribers = {}  # user_id -> set of asyncio.Queue
+        self._count = 0
+        self._lock = threading.Lock()
+        self._loop = None
+        self._ids = itertools.count(1)
+
+    def subscribe(self, user_id: int) -> asyncio.Queue:
+        """Register a stream for user_id; must be called on the event loop"""
+        self._loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._count >= self.max_connections:
+                raise TooManyConnections("Too many open streams")
+            queues = self._subscribers.setdefault(user_id, set())
+            if len(queues) >= self.max_per_user:
+                raise TooManyConnections("Too many open streams for this user")
+            q = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+            queues.add(q)
+            self._count += 1
+        return q
+
+    def unsubscribe(self, user_id: int, q: asyncio.Queue):
+        with self._lock:
+            queues = self._subscribers.get(user_id)
+            if queues and q in queues:
+                queues.discard(q)
+                self._count -= 1
+                if not queues:
+                    del self._subscribers[user_id]
+
+    def has_subscribers(self, user_id=None) -> bool:
+        """True if user_id (or anyone, when user_id is None) is listening"""
+        with self._lock:
+            if user_id is None:
+                return self._count > 0
+            return bool(self._subscribers.get(user_id))
+
+    def subscribed_users(self) -> list:
+        with self._lock:
+            return list(self._subscribers)
+
+    def publish(self, user_id, event_type: str, data):
+        """Send an event to one user's streams, or to every stream if user_id is None"""
+        if not self._loop or not self.has_subscribers(user_id):
+            return
+        event = {"id": next(self._ids), "type": event_type, "data": data}
+        try:
+            self._loop.call_soon_threadsafe(self._deliver, user_id, event)
+        except RuntimeError:
+            pass  # loop closed during shutdown
+
+    def _deliver(self, user_id, event):
+        with self._lock:
+            if user_id is None:
+                targets = [q for queues in self._subscribers.values() for q in queues]
+            else:
+                targets = list(self._subscribers.get(user_id, ()))
+        for q in targets:
+            try:
+                q.put_nowait(event)
+            except asyncio.QueueFull:
+                # Slow client: drop the backlog and ask it to refetch once
+                while not q.empty():
+                    q.get_nowait()
+                q.put_nowait({"id": event["id"], "type": "resync", "data": {}})
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"connections": self._count, "users": len(self._subscribers)}
+
+
+def format_sse(event: dict) -> str:
+    """Serialize an event in text/event-stream format"""
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+
+async def event_stream(broker: EventBroker, user_id: int, q: asyncio.Queue, request,
+                       heartbeat: float = SSE_HEARTBEAT):
+    """Yield SSE frames for a subscriber until the client disconnects"""
+    try:
+        yield f"retry: {int(heartbeat * 1000)}\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(q.get(), timeout=heartbeat)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                yield ": heartbeat\n\n"
+                continue
+            yield format_sse(event)
+    finally:
+        broker.unsubscribe(user_id, q)
+
+
+broker = EventBroker()
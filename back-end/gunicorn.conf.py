@@ -0,0 +1,44 @@
+"""Multi-process server: gunicorn master with uvicorn workers.
+
+    gunicorn main:app -c gunicorn.conf.py
+
+The master creates the schema once before forking, so workers skip the
+`init_schema()` call in main.py and start serving straight away.
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+# Fixed default: inside a container cpu_count() is the host's core count, not
+# the CPU quota, and every worker holds its own caches and analytics snapshot
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn_worker.UvicornWorker"
+graceful_timeout = 30
+timeout = 60
+keepalive = 5
+
+
+def on_starting(server):
+    import snapshot
+
+    # Before anything opens the database
+    if snapshot.SNAPSHOT_ENABLED:
+        restored = snapshot.restore_latest()
+        if restored:
+            print(f"Restored database from {restored}")
+
+    from database import engine, init_schema, read_engine
+
+    init_schema()
+    # Don't hand pooled connections to forked workers
+    engine.dispose()
+    read_engine.dispose()
+    # Inherited by every worker
+    os.environ["SCHEMA_READY"] = "1"
+    os.environ["MULTI_WORKER"] = "1"
+
+
+def on_exit(server):
+    import snapshot
+
+    if snapshot.SNAPSHOT_ENABLED:
+        snapshot.Snapshotter().run_once()
@@ -1,8 +1,9 @@
-from database import SessionLocal, engine
+from database import SessionLocal, init_schema
+from shared_state import bump
 import models
 
 # Create tables
-models.Base.metadata.create_all(bind=engine)
+init_schema()
 
 db = SessionLocal()
 
@@ -109,6 +110,9 @@ else:
     db.add_all(foods)
 
     db.commit()
+    # The only path here that writes the cached seed tables: running servers
+    # poll this counter and drop their cached dashboard responses
+    bump("dashboard")
     print("Database initialized successfully.")
 
 db.close()
@@ -1,22 +1,120 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+import startup_profile
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, TypeAdapter
 from typing import List, Optional
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import text
 import models
-from database import SessionLocal, engine
+from database import SessionLocal, READ_DATABASE_URL, engine, init_schema, read_session, schema_is_current
+from write_behind import write_queue, QueueFull
+from events import broker, event_stream, TooManyConnections
+from response_cache import response_cache
+from rate_limit import RateLimitMiddleware, WRITE_METHODS, client_key, metrics as rate_limit_metrics
+import shared_state
+from shared_state import store_token, lookup_token, revoke_token, signal_user
+import archive
+import snapshot
+import recompute
+from recipes import recipe_totals, check_no_cycle, invalidate_recipes, RecipeCycleError
+import teams
+import change_log
+import asyncio
+from collections import OrderedDict
+import csv
+import io
+import itertools
 import hashlib
+import os
 import secrets
-import json
+import threading
+import time
+import traceback
 
-models.Base.metadata.create_all(bind=engine)
+startup_profile.mark("imports")
 
-app = FastAPI()
+# Recover from the newest snapshot before anything opens the database (under
+# gunicorn the master has already done this)
+if snapshot.SNAPSHOT_ENABLED and os.getenv("SCHEMA_READY") != "1":
+    restored = snapshot.restore_latest()
+    if restored:
+        print(f"Restored database from {restored}")
+startup_profile.mark("restore")
 
-# Simple token storage (in production, use Redis or JWT)
-active_tokens = {}
+# Under gunicorn the master creates the schema once before forking workers.
+# Otherwise only create tables here if some are missing (fresh database);
+# the full check runs in the background after startup.
+if os.getenv("SCHEMA_READY") != "1" and not schema_is_current():
+    init_schema()
+startup_profile.mark("schema")
+
+def deferred_startup():
+    """Non-critical startup work, run after the server starts accepting requests"""
+    try:
+        # Under gunicorn the master already ran the full schema check
+        if os.getenv("SCHEMA_READY") != "1":
+            init_schema()
+        db = SessionLocal()
+        try:
+            # Seed verification
+            if not db.query(models.DashboardSummary).first():
+                print("Warning: dashboard seed data missing, run init_db.py")
+            if not db.query(models.Food).first():
+                print("Warning: food catalog empty, run init_db.py")
+            shared_state.purge_tokens(db)
+            # Catalog warm-up: load pages into SQLite's cache and prime cached responses
+            db.query(models.Food).all()
+            for route, build in DASHBOARD_BUILDERS.items():
+                try:
+                    response_cache.prime(route, lambda: build(db))
+                except HTTPException:
+                    pass
+        finally:
+            db.close()
+        get_analytics().start()
+    except Exception:
+        # Nothing awaits this task, so report failures here
+        print("Deferred startup failed:")
+        traceback.print_exc()
+    startup_profile.mark("warmup")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if write_queue.enabled:
+        write_queue.start()
+    watcher = asyncio.create_task(watch_shared_state()) if shared_state.MULTI_WORKER else None
+    warmup = asyncio.create_task(run_in_threadpool(deferred_startup))
+    archiver = archive.Archiver(SessionLocal) if archive.ARCHIVE_ENABLED else None
+    if archiver:
+        archiver.start()
+    snapshotter = snapshot.Snapshotter() if snapshot.SNAPSHOT_ENABLED else None
+    if snapshotter:
+        snapshotter.start()
+    recomputer.start()
+    startup_profile.mark("lifespan")
+    yield
+    warmup.cancel()
+    if analytics_store:
+        analytics_store.stop()
+    if archiver:
+        archiver.stop()
+    if snapshotter:
+        snapshotter.stop()
+    recomputer.stop()
+    if watcher:
+        watcher.cancel()
+    write_queue.stop()
+    # Final snapshot after pending writes are flushed; under gunicorn the
+    # master takes it once every worker has exited
+    if snapshotter and not shared_state.MULTI_WORKER:
+        await run_in_threadpool(snapshotter.run_once)
+
+app = FastAPI(lifespan=lifespan)
 
 security = HTTPBearer(auto_error=False)
 
@@ -28,6 +126,11 @@ origins = [
     "https://impact-dashboard.vercel.app",
 ]
 
+app.add_middleware(startup_profile.FirstRequestTimer)
+
+# Inside CORS so 429/503 responses still carry CORS headers
+app.add_middleware(RateLimitMiddleware, write_queue=write_queue)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Allow all origins for now
@@ -36,14 +139,47 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Dependency
-def get_db():
+# ============ SESSION DEPENDENCIES ============
+
+# With a separate replica, clients that just wrote read from the primary for a
+# few seconds so they see their own changes despite replication lag
+READ_AFTER_WRITE_SECONDS = float(os.getenv("READ_AFTER_WRITE_SECONDS", "5"))
+recent_writers = OrderedDict()  # client key -> monotonic time of last write
+recent_writers_lock = threading.Lock()  # sync dependencies run on threadpool threads
+
+def note_write(key: str):
+    with recent_writers_lock:
+        recent_writers[key] = time.monotonic()
+        recent_writers.move_to_end(key)
+        while len(recent_writers) > 10000:
+            recent_writers.popitem(last=False)
+
+def wrote_recently(key: str) -> bool:
+    with recent_writers_lock:
+        last = recent_writers.get(key)
+    return last is not None and time.monotonic() - last < READ_AFTER_WRITE_SECONDS
+
+def get_write_db(request: Request):
+    """Session on the primary, for endpoints that write or need the latest state"""
+    if READ_DATABASE_URL and request.method in WRITE_METHODS:
+        note_write(client_key(request.scope))
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
 
+def get_read_db(request: Request):
+    """Session for read-only endpoints; falls back to the primary when the replica is down"""
+    if READ_DATABASE_URL and wrote_recently(client_key(request.scope)):
+        db = SessionLocal()
+    else:
+        db = read_session()
+    try:
+        yield db
+    finally:
+        db.close()
+
 # ============ AUTHENTICATION HELPERS ============
 
 def hash_password(password: str) -> str:
@@ -60,21 +196,17 @@ def create_token() -> str:
 
 def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_write_db)
 ):
     """Get current user from token"""
     if not credentials:
         return None
-    token = credentials.credentials
-    if token not in active_tokens:
-        return None
-    user_id = active_tokens[token]
-    user = db.query(models.User).filter(models.User.id == user_id).first()
-    return user
+    user_id = lookup_token(db, credentials.credentials)
+    return db.get(models.User, user_id) if user_id is not None else None
 
 def require_auth(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_write_db)
 ):
     """Require authentication"""
     user = get_current_user(credentials, db)
@@ -82,6 +214,17 @@ def require_auth(
         raise HTTPException(status_code=401, detail="Not authenticated")
     return user
 
+# Operator endpoints (publishing emission factors) need this shared secret in
+# X-Admin-Token; they are disabled while it is unset
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Require the operator admin token"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin API is disabled")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
 # ============ AUTH PYDANTIC MODELS ============
 
 class UserCreate(BaseModel):
@@ -111,7 +254,7 @@ class AuthResponse(BaseModel):
 # ============ AUTH ENDPOINTS ============
 
 @app.post("/api/auth/register", response_model=AuthResponse)
-def register(user_data: UserCreate, db: Session = Depends(get_db)):
+def register(user_data: UserCreate, db: Session = Depends(get_write_db)):
     """Register a new user"""
     # Check if email exists
     if db.query(models.User).filter(models.User.email == user_data.email).first():
@@ -138,12 +281,12 @@ def register(user_data: UserCreate, db: Session = Depends(get_db)):
     
     # Create token
     token = create_token()
-    active_tokens[token] = user.id
+    store_token(db, token, user.id)
     
     return {"token": token, "user": user}
 
 @app.post("/api/auth/login", response_model=AuthResponse)
-def login(credentials: UserLogin, db: Session = Depends(get_db)):
+def login(credentials: UserLogin, db: Session = Depends(get_write_db)):
     """Login user"""
     # Find by username or email
     user = db.query(models.User).filter(
@@ -156,12 +299,12 @@ def login(credentials: UserLogin, db: Session = Depends(get_db)):
     
     # Create token
     token = create_token()
-    active_tokens[token] = user.id
+    store_token(db, token, user.id)
     
     return {"token": token, "user": user}
 
 @app.post("/api/auth/demo-login", response_model=AuthResponse)
-def demo_login(db: Session = Depends(get_db)):
+def demo_login(db: Session = Depends(get_write_db)):
     """Login as demo user (Alex)"""
     # Find or create demo user
     demo_user = db.query(models.User).filter(models.User.username == "alex_demo").first()
@@ -183,15 +326,18 @@ def demo_login(db: Session = Depends(get_db)):
     
     # Create token
     token = create_token()
-    active_tokens[token] = demo_user.id
+    store_token(db, token, demo_user.id)
     
     return {"token": token, "user": demo_user}
 
 @app.post("/api/auth/logout")
-def logout(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def logout(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: Session = Depends(get_write_db)
+):
     """Logout user"""
-    if credentials and credentials.credentials in active_tokens:
-        del active_tokens[credentials.credentials]
+    if credentials:
+        revoke_token(db, credentials.credentials)
     return {"message": "Logged out successfully"}
 
 @app.get("/api/auth/me", response_model=UserResponse)
@@ -274,48 +420,56 @@ def init_demo_user_data(db: Session, user_id: int):
 
 # ============ USER-SPECIFIC DASHBOARD ENDPOINTS ============
 
+def build_user_summary(db: Session, user_id: int) -> dict:
+    """Compute the dashboard summary for a user"""
+    weekly_data = db.query(models.UserWeeklyData).filter(
+        models.UserWeeklyData.user_id == user_id
+    ).order_by(models.UserWeeklyData.id).all()
+    
+    recent_footprint = sum(w.footprint for w in weekly_data[-4:])
+    previous_footprint = sum(w.footprint for w in weekly_data[-8:-4])
+    recent_saved = sum(w.saved for w in weekly_data[-4:]) if weekly_data else 0
+    
+    badges = db.query(models.UserBadge).filter(
+        models.UserBadge.user_id == user_id
+    ).all()
+    unlocked = sum(1 for b in badges if b.unlocked)
+    
+    # Calculate streak (consecutive days with challenges); archived months
+    # are only read if the streak covers every hot completion
+    streak = 0
+    hot_rows = 0
+    today = datetime.utcnow().date()
+    for c in archive.completions_desc(db, user_id, archived=False):
+        hot_rows += 1
+        if (today - c["completed_at"].date()).days > streak + 1:
+            break
+        streak += 1
+    if streak and streak == hot_rows:
+        for c in archive.archived_completions_desc(user_id):
+            if (today - c["completed_at"].date()).days > streak + 1:
+                break
+            streak += 1
+    
+    return {
+        "co2Emitted": recent_footprint,
+        "co2Saved": recent_saved,
+        "streak": streak,
+        "badgesUnlocked": unlocked,
+        "totalBadges": len(badges),
+        # Last four weeks' footprint against the four before
+        "percentChange": round((recent_footprint - previous_footprint) / previous_footprint * 100, 1) if previous_footprint else 0
+    }
+
 @app.get("/api/user/dashboard/summary")
 def get_user_summary(
     user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """Get dashboard summary for current user or default"""
     if user:
-        # Get user-specific data
-        weekly_data = db.query(models.UserWeeklyData).filter(
-            models.UserWeeklyData.user_id == user.id
-        ).all()
-        
-        total_saved = sum(w.saved for w in weekly_data)
-        recent_saved = sum(w.saved for w in weekly_data[-4:]) if weekly_data else 0
-        
-        badges = db.query(models.UserBadge).filter(
-            models.UserBadge.user_id == user.id
-        ).all()
-        unlocked = sum(1 for b in badges if b.unlocked)
-        
-        # Calculate streak (consecutive days with challenges)
-        completions = db.query(models.ChallengeCompletion).filter(
-            models.ChallengeCompletion.user_id == user.id
-        ).order_by(models.ChallengeCompletion.completed_at.desc()).all()
-        
-        streak = 0
-        if completions:
-            today = datetime.utcnow().date()
-            for i, c in enumerate(completions):
-                if (today - c.completed_at.date()).days <= i + 1:
-                    streak += 1
-                else:
-                    break
-        
-        return {
-            "co2Emitted": sum(w.footprint for w in weekly_data[-4:]) if weekly_data else 0,
-            "co2Saved": recent_saved,
-            "streak": streak,
-            "badgesUnlocked": unlocked,
-            "totalBadges": len(badges),
-            "percentChange": -12.5 if total_saved > 0 else 0
-        }
+        write_queue.sync_user(user.id)
+        return build_user_summary(db, user.id)
     
     # Fallback to default summary
     summary = db.query(models.DashboardSummary).first()
@@ -326,10 +480,11 @@ def get_user_summary(
 @app.get("/api/user/dashboard/chart")
 def get_user_chart(
     user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """Get chart data for current user"""
     if user:
+        write_queue.sync_user(user.id)
         weekly_data = db.query(models.UserWeeklyData).filter(
             models.UserWeeklyData.user_id == user.id
         ).order_by(models.UserWeeklyData.id).all()
@@ -344,7 +499,7 @@ def complete_challenge(
     challenge_id: int,
     co2_saved: float,
     user: models.User = Depends(require_auth),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_write_db)
 ):
     """Mark a challenge as completed"""
     # Check if already completed today
@@ -355,9 +510,17 @@ def complete_challenge(
     ).all()
     
     today_completion = [c for c in existing if c.completed_at.date() == today]
-    if today_completion:
+    if today_completion or (write_queue.enabled and write_queue.has_pending_challenge(user.id, challenge_id, today)):
         raise HTTPException(status_code=400, detail="Challenge already completed today")
     
+    if write_queue.enabled:
+        # Write-behind: the worker inserts the completion and updates the week
+        try:
+            write_queue.submit_challenge(user.id, challenge_id, co2_saved)
+        except QueueFull:
+            raise HTTPException(status_code=503, detail="Server busy, please retry")
+        return {"message": "Challenge completed!", "co2_saved": co2_saved}
+    
     # Create completion
     completion = models.ChallengeCompletion(
         user_id=user.id,
@@ -376,28 +539,155 @@ def complete_challenge(
     
     db.commit()
     
+    broker.publish(user.id, "challenge_completed", {"challenge_id": challenge_id, "co2_saved": co2_saved})
+    publish_user_update(db, user.id)
+    signal_user(user.id)
+    
     return {"message": "Challenge completed!", "co2_saved": co2_saved}
 
 @app.get("/api/user/challenges/history")
 def get_challenge_history(
     user: models.User = Depends(require_auth),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """Get user's challenge completion history"""
-    completions = db.query(models.ChallengeCompletion).filter(
-        models.ChallengeCompletion.user_id == user.id
-    ).order_by(models.ChallengeCompletion.completed_at.desc()).limit(50).all()
+    write_queue.sync_user(user.id)
+    completions = itertools.islice(archive.completions_desc(db, user.id), 50)
     
     return [
         {
-            "id": c.id,
-            "challenge_id": c.challenge_id,
-            "co2_saved": c.co2_saved,
-            "completed_at": c.completed_at.isoformat()
+            "id": c["id"],
+            "challenge_id": c["challenge_id"],
+            "co2_saved": c["co2_saved"],
+            "completed_at": c["completed_at"].isoformat()
         }
         for c in completions
     ]
 
+@app.get("/api/user/challenges/export")
+def export_challenge_history(
+    user: models.User = Depends(require_auth),
+    db: Session = Depends(get_read_db)
+):
+    """Download the user's full challenge history (including archived months) as CSV"""
+    write_queue.sync_user(user.id)
+    
+    def rows():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["id", "challenge_id", "co2_saved", "completed_at"])
+        for c in archive.completions_desc(db, user.id):
+            writer.writerow([c["id"], c["challenge_id"], c["co2_saved"], c["completed_at"].isoformat()])
+            if buffer.tell() > 8192:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    
+    return StreamingResponse(rows(), media_type="text/csv", headers={
+        "Content-Disposition": "attachment; filename=challenge_history.csv"
+    })
+
+# ============ LIVE UPDATES (SSE) ============
+
+def publish_user_update(db: Session, user_id: int):
+    """Push the user's new totals and current week to their open streams"""
+    if not broker.has_subscribers(user_id):
+        return
+    broker.publish(user_id, "summary", build_user_summary(db, user_id))
+    current_week = db.query(models.UserWeeklyData).filter(
+        models.UserWeeklyData.user_id == user_id
+    ).order_by(models.UserWeeklyData.id.desc()).first()
+    if current_week:
+        broker.publish(user_id, "chart", {
+            "week": current_week.week,
+            "footprint": current_week.footprint,
+            "saved": current_week.saved,
+            "baseline": current_week.baseline
+        })
+
+def on_write_behind_commit(events):
+    """Publish deltas once queued writes reach the database"""
+    for user_id in {e["user_id"] for e in events if e["kind"] == "challenge"}:
+        signal_user(user_id)
+    if not broker.has_subscribers():
+        return
+    db = SessionLocal()
+    try:
+        challenges = [e for e in events if e["kind"] == "challenge"]
+        for e in challenges:
+            broker.publish(e["user_id"], "challenge_completed", {
+                "challenge_id": e["data"]["challenge_id"],
+                "co2_saved": e["data"]["co2_saved"]
+            })
+        for user_id in {e["user_id"] for e in challenges}:
+            publish_user_update(db, user_id)
+        for e in events:
+            if e["kind"] == "food":
+                broker.publish(None, "activity", {
+                    "id": None,
+                    "food_name": activity_name(db, e["data"]["food_id"], e["data"].get("recipe_id")),
+                    "quantity_grams": e["data"]["quantity_grams"],
+                    "co2_impact": e["data"]["co2_impact"],
+                    "logged_at": e["data"]["logged_at"]
+                })
+    finally:
+        db.close()
+
+write_queue.add_listener(on_write_behind_commit)
+
+def resolve_token(token: str):
+    db = SessionLocal()
+    try:
+        return lookup_token(db, token)
+    finally:
+        db.close()
+
+def publish_shared_updates():
+    """Publish updates for subscribed users whose data changed in another worker"""
+    names = [f"user:{user_id}" for user_id in broker.subscribed_users()]
+    changed = shared_state.user_signals.changed(names) if names else []
+    if not changed:
+        return
+    db = SessionLocal()
+    try:
+        for name in changed:
+            publish_user_update(db, int(name.split(":", 1)[1]))
+    finally:
+        db.close()
+
+async def watch_shared_state():
+    while True:
+        await asyncio.sleep(shared_state.POLL_INTERVAL)
+        try:
+            await run_in_threadpool(publish_shared_updates)
+        except Exception as e:
+            print(f"Shared state poll failed: {e}")
+
+@app.get("/api/user/stream")
+async def user_stream(
+    request: Request,
+    token: Optional[str] = None,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Server-sent events with live dashboard deltas for the current user.
+    
+    EventSource can't set headers, so the token may also be passed as ?token=.
+    """
+    token = credentials.credentials if credentials else token
+    user_id = await run_in_threadpool(resolve_token, token) if token else None
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    try:
+        q = broker.subscribe(user_id)
+    except TooManyConnections as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    return StreamingResponse(
+        event_stream(broker, user_id, q, request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # Pydantic Models (Response Models)
 class WeeklyData(BaseModel):
     week: str
@@ -468,9 +758,92 @@ class DashboardDetails(BaseModel):
 def read_root():
     return {"status": "ok", "message": "Impact Dashboard Backend is running"}
 
+# ============ DELTA SYNC ============
+
+@app.get("/api/sync")
+def sync_changes(
+    since: int = 0,
+    limit: int = 500,
+    user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    """Catalog (and, when logged in, the user's own) changes after a version.
+
+    Pass the returned `version` as `since` on the next call, while `has_more` is true.
+    """
+    if user:
+        write_queue.sync_user(user.id)
+    return change_log.changes_since(db, since, user.id if user else None, limit)
+
+# ============ HEALTH CHECKS ============
+
+@app.get("/api/health/live")
+def liveness():
+    """Process is up"""
+    return {"status": "ok"}
+
+@app.get("/api/health/ready")
+def readiness(db: Session = Depends(get_write_db)):
+    """Process can serve traffic: database reachable and write queue not saturated"""
+    try:
+        db.execute(text("SELECT 1"))
+    except Exception:
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    if write_queue.enabled and write_queue.stats()["pending"] >= write_queue.max_queue:
+        raise HTTPException(status_code=503, detail="Write queue saturated")
+    return {"status": "ready", "pid": os.getpid()}
+
+@app.get("/api/metrics/rate-limit")
+def rate_limit_report():
+    """Admitted and rejected write requests since this process started"""
+    return rate_limit_metrics.snapshot()
+
+@app.get("/api/health/startup")
+def startup_report():
+    """Seconds since process start at which each startup phase finished"""
+    return startup_profile.report()
+
+# ============ ANALYTICS ============
+
+analytics_store = None
+analytics_lock = threading.Lock()  # warm-up and the first request may race to create it
+
+def get_analytics():
+    """Snapshot store, created on first use so NumPy stays off the cold start path"""
+    global analytics_store
+    if analytics_store is None:
+        with analytics_lock:
+            if analytics_store is None:
+                import analytics
+                analytics_store = analytics.SnapshotStore(read_session)
+    return analytics_store
+
+@app.get("/api/analytics/overview")
+def analytics_overview():
+    """Percent change and saved/completion percentiles across all users"""
+    return get_analytics().get().overview()
+
+@app.get("/api/analytics/me")
+def analytics_me(user: models.User = Depends(require_auth)):
+    """Where the current user sits against everyone and against their signup cohort"""
+    stats = get_analytics().get().user(user.id)
+    if stats is None:
+        raise HTTPException(status_code=404, detail="Not in the latest snapshot yet")
+    return stats
+
+@app.get("/api/analytics/categories")
+def analytics_categories():
+    """Logged CO2 by food category"""
+    return get_analytics().get().categories()
+
+@app.get("/api/analytics/cohorts")
+def analytics_cohorts():
+    """Average savings and completions per signup month"""
+    return get_analytics().get().cohorts()
+
 # One-time fix endpoint to update Plant Pioneer badge
 @app.get("/api/fix-badges")
-def fix_badges(db: Session = Depends(get_db)):
+def fix_badges(db: Session = Depends(get_write_db)):
     # Update Plant Pioneer to unlocked (user has 226kg saved > 200kg requirement)
     plant_pioneer = db.query(models.Badge).filter(models.Badge.name == "Plant Pioneer").first()
     if plant_pioneer:
@@ -485,43 +858,79 @@ def fix_badges(db: Session = Depends(get_db)):
     
     return {"status": "fixed", "message": "Plant Pioneer badge unlocked, summary updated to 5 badges"}
 
-@app.get("/api/dashboard/summary", response_model=DashboardSummary)
-def get_dashboard_summary(db: Session = Depends(get_db)):
+# Global dashboard data only changes via init_db.py or /api/fix-badges, so these
+# endpoints are served as cached bytes with ETag / Cache-Control headers.
+# Rebuilds read the primary so a lagging replica's copy is never cached.
+response_cache.watch(
+    models.DashboardSummary, models.WeeklyData, models.Badge, models.MonthlyGoal,
+    models.EmittedData, models.SavedItem, models.StreakDay, models.Contribution, models.ImpactDetail
+)
+
+def to_json(response_type, value) -> bytes:
+    """Validate and serialize with a response model"""
+    adapter = TypeAdapter(response_type)
+    return adapter.dump_json(adapter.validate_python(value, from_attributes=True))
+
+def build_dashboard_summary(db: Session) -> bytes:
     summary = db.query(models.DashboardSummary).first()
     if not summary:
         raise HTTPException(status_code=404, detail="Summary not found")
-    return summary
+    return to_json(DashboardSummary, summary)
 
-@app.get("/api/dashboard/chart", response_model=List[WeeklyData])
-def get_dashboard_chart(db: Session = Depends(get_db)):
-    return db.query(models.WeeklyData).all()
+def build_dashboard_chart(db: Session) -> bytes:
+    return to_json(List[WeeklyData], db.query(models.WeeklyData).all())
 
-@app.get("/api/dashboard/badges", response_model=List[Badge])
-def get_badges(db: Session = Depends(get_db)):
-    return db.query(models.Badge).all()
+def build_badges(db: Session) -> bytes:
+    return to_json(List[Badge], db.query(models.Badge).all())
 
-@app.get("/api/dashboard/goal", response_model=MonthlyGoal)
-def get_monthly_goal(db: Session = Depends(get_db)):
+def build_monthly_goal(db: Session) -> bytes:
     goal = db.query(models.MonthlyGoal).first()
     if not goal:
         raise HTTPException(status_code=404, detail="Goal not found")
-    return goal
+    return to_json(MonthlyGoal, goal)
 
-@app.get("/api/dashboard/details", response_model=DashboardDetails)
-def get_dashboard_details(db: Session = Depends(get_db)):
+def build_dashboard_details(db: Session) -> bytes:
     emitted = db.query(models.EmittedData).all()
     saved = db.query(models.SavedItem).all()
     streak_days = db.query(models.StreakDay).order_by(models.StreakDay.day_index).all()
     contributions = db.query(models.Contribution).all()
     impact = db.query(models.ImpactDetail).all()
     
-    return {
+    return to_json(DashboardDetails, {
         "emitted": emitted,
         "saved": saved,
         "streak": [day.completed for day in streak_days],
         "contributions": contributions,
         "impact": impact
-    }
+    })
+
+DASHBOARD_BUILDERS = {
+    "dashboard/summary": build_dashboard_summary,
+    "dashboard/chart": build_dashboard_chart,
+    "dashboard/badges": build_badges,
+    "dashboard/goal": build_monthly_goal,
+    "dashboard/details": build_dashboard_details,
+}
+
+@app.get("/api/dashboard/summary", response_model=DashboardSummary)
+def get_dashboard_summary(request: Request, db: Session = Depends(get_write_db)):
+    return response_cache.respond(request, "dashboard/summary", lambda: build_dashboard_summary(db))
+
+@app.get("/api/dashboard/chart", response_model=List[WeeklyData])
+def get_dashboard_chart(request: Request, db: Session = Depends(get_write_db)):
+    return response_cache.respond(request, "dashboard/chart", lambda: build_dashboard_chart(db))
+
+@app.get("/api/dashboard/badges", response_model=List[Badge])
+def get_badges(request: Request, db: Session = Depends(get_write_db)):
+    return response_cache.respond(request, "dashboard/badges", lambda: build_badges(db))
+
+@app.get("/api/dashboard/goal", response_model=MonthlyGoal)
+def get_monthly_goal(request: Request, db: Session = Depends(get_write_db)):
+    return response_cache.respond(request, "dashboard/goal", lambda: build_monthly_goal(db))
+
+@app.get("/api/dashboard/details", response_model=DashboardDetails)
+def get_dashboard_details(request: Request, db: Session = Depends(get_write_db)):
+    return response_cache.respond(request, "dashboard/details", lambda: build_dashboard_details(db))
 
 # ============ FOOD API ============
 
@@ -543,7 +952,7 @@ class LogFoodRequest(BaseModel):
     quantity_grams: float
 
 class LogFoodResponse(BaseModel):
-    id: int
+    id: Optional[int] = None  # None while queued in write-behind mode
     food_name: str
     quantity_grams: float
     co2_impact: float
@@ -554,7 +963,7 @@ def get_foods(
     category: Optional[str] = None,
     is_veg: Optional[bool] = None,
     search: Optional[str] = None,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """Get all foods with optional filters"""
     query = db.query(models.Food)
@@ -569,13 +978,13 @@ def get_foods(
     return query.all()
 
 @app.get("/api/foods/categories")
-def get_food_categories(db: Session = Depends(get_db)):
+def get_food_categories(db: Session = Depends(get_read_db)):
     """Get unique food categories"""
     categories = db.query(models.Food.category).distinct().all()
     return ["all"] + [c[0] for c in categories]
 
 @app.get("/api/foods/{food_id}", response_model=FoodResponse)
-def get_food(food_id: int, db: Session = Depends(get_db)):
+def get_food(food_id: int, db: Session = Depends(get_read_db)):
     """Get a specific food by ID"""
     food = db.query(models.Food).filter(models.Food.id == food_id).first()
     if not food:
@@ -583,7 +992,11 @@ def get_food(food_id: int, db: Session = Depends(get_db)):
     return food
 
 @app.post("/api/log-food", response_model=LogFoodResponse)
-def log_food(request: LogFoodRequest, db: Session = Depends(get_db)):
+def log_food(
+    request: LogFoodRequest,
+    user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_write_db)
+):
     """Log food consumption and calculate CO2 impact"""
     from datetime import datetime
     
@@ -594,37 +1007,502 @@ def log_food(request: LogFoodRequest, db: Session = Depends(get_db)):
     # Calculate CO2 impact (per 100g scaled to quantity)
     co2_impact = (food.co2_per_100g * request.quantity_grams) / 100
     
+    if write_queue.enabled:
+        logged_at = datetime.now().isoformat()
+        try:
+            write_queue.submit_food(request.food_id, request.quantity_grams, round(co2_impact, 2), logged_at,
+                                    user_id=user.id if user else None, factor_version=food.factor_version or 1)
+        except QueueFull:
+            raise HTTPException(status_code=503, detail="Server busy, please retry")
+        return {
+            "id": None,
+            "food_name": food.name,
+            "quantity_grams": request.quantity_grams,
+            "co2_impact": round(co2_impact, 2),
+            "logged_at": logged_at
+        }
+    
     # Create log entry
     log_entry = models.ActivityLog(
         food_id=request.food_id,
+        user_id=user.id if user else None,
         quantity_grams=request.quantity_grams,
         co2_impact=round(co2_impact, 2),
+        factor_version=food.factor_version or 1,
         logged_at=datetime.now().isoformat()
     )
     db.add(log_entry)
     db.commit()
     db.refresh(log_entry)
     
-    return {
+    result = {
         "id": log_entry.id,
         "food_name": food.name,
         "quantity_grams": request.quantity_grams,
         "co2_impact": round(co2_impact, 2),
         "logged_at": log_entry.logged_at
     }
+    broker.publish(None, "activity", result)
+    return result
+
+def activity_name(db: Session, food_id: Optional[int], recipe_id: Optional[int] = None) -> str:
+    """Display name for an activity log row (a food or a recipe)"""
+    if recipe_id is not None:
+        recipe = db.get(models.Recipe, recipe_id)
+        return recipe.name if recipe else "Unknown"
+    food = db.query(models.Food).filter(models.Food.id == food_id).first()
+    return food.name if food else "Unknown"
 
 @app.get("/api/activity-logs")
-def get_activity_logs(limit: int = 10, db: Session = Depends(get_db)):
+def get_activity_logs(limit: int = Query(10, ge=1, le=1000), db: Session = Depends(get_read_db)):
     """Get recent activity logs"""
-    logs = db.query(models.ActivityLog).order_by(models.ActivityLog.id.desc()).limit(limit).all()
+    logs = list(itertools.islice(archive.activity_logs_desc(db), limit))
     result = []
     for log in logs:
-        food = db.query(models.Food).filter(models.Food.id == log.food_id).first()
         result.append({
-            "id": log.id,
-            "food_name": food.name if food else "Unknown",
-            "quantity_grams": log.quantity_grams,
-            "co2_impact": log.co2_impact,
-            "logged_at": log.logged_at
+            "id": log["id"],
+            "food_name": activity_name(db, log["food_id"], log.get("recipe_id")),
+            "quantity_grams": log["quantity_grams"],
+            "co2_impact": log["co2_impact"],
+            "logged_at": log["logged_at"]
         })
     return result
+
+# ============ RECIPE API ============
+
+class RecipeIngredientIn(BaseModel):
+    food_id: Optional[int] = None
+    recipe_id: Optional[int] = None
+    quantity: float  # grams of a food, or servings of a recipe
+
+class RecipeCreate(BaseModel):
+    name: str
+    servings: int = 1
+    ingredients: List[RecipeIngredientIn]
+
+class RecipeIngredientResponse(BaseModel):
+    food_id: Optional[int] = None
+    recipe_id: Optional[int] = None
+    name: str
+    quantity: float
+
+class RecipeSummary(BaseModel):
+    id: int
+    name: str
+    servings: int
+    co2_per_serving: float
+    protein_per_serving: float
+    grams_per_serving: float
+
+class RecipeResponse(RecipeSummary):
+    ingredients: List[RecipeIngredientResponse]
+
+class LogRecipeRequest(BaseModel):
+    recipe_id: int
+    servings: float = 1
+
+def recipe_summary(db: Session, recipe: models.Recipe) -> dict:
+    return {"id": recipe.id, "name": recipe.name, "servings": recipe.servings, **recipe_totals(db, recipe)}
+
+def recipe_detail(db: Session, recipe: models.Recipe) -> dict:
+    return {
+        **recipe_summary(db, recipe),
+        "ingredients": [
+            {
+                "food_id": i.food_id,
+                "recipe_id": i.sub_recipe_id,
+                "name": activity_name(db, i.food_id, i.sub_recipe_id),
+                "quantity": i.quantity
+            }
+            for i in recipe.ingredients
+        ]
+    }
+
+def build_ingredients(db: Session, ingredients: List[RecipeIngredientIn]) -> List[models.RecipeIngredient]:
+    """Validate ingredient references and build rows"""
+    rows = []
+    for i in ingredients:
+        if (i.food_id is None) == (i.recipe_id is None):
+            raise HTTPException(status_code=400, detail="Each ingredient needs exactly one of food_id or recipe_id")
+        if i.food_id is not None and not db.get(models.Food, i.food_id):
+            raise HTTPException(status_code=404, detail=f"Food {i.food_id} not found")
+        if i.recipe_id is not None and not db.get(models.Recipe, i.recipe_id):
+            raise HTTPException(status_code=404, detail=f"Recipe {i.recipe_id} not found")
+        rows.append(models.RecipeIngredient(food_id=i.food_id, sub_recipe_id=i.recipe_id, quantity=i.quantity))
+    return rows
+
+def get_recipe_or_404(db: Session, recipe_id: int) -> models.Recipe:
+    recipe = db.get(models.Recipe, recipe_id)
+    if not recipe:
+        raise HTTPException(status_code=404, detail="Recipe not found")
+    return recipe
+
+@app.get("/api/recipes", response_model=List[RecipeSummary])
+def get_recipes(db: Session = Depends(get_write_db)):
+    """List recipes with per-serving totals"""
+    result = [recipe_summary(db, r) for r in db.query(models.Recipe).order_by(models.Recipe.name).all()]
+    db.commit()  # persist any totals that had to be recomputed
+    return result
+
+@app.post("/api/recipes", response_model=RecipeResponse)
+def create_recipe(recipe_data: RecipeCreate, db: Session = Depends(get_write_db)):
+    """Create a recipe from foods and other recipes"""
+    if recipe_data.servings < 1:
+        raise HTTPException(status_code=400, detail="Servings must be at least 1")
+    recipe = models.Recipe(
+        name=recipe_data.name,
+        servings=recipe_data.servings,
+        ingredients=build_ingredients(db, recipe_data.ingredients)
+    )
+    db.add(recipe)
+    db.flush()
+    result = recipe_detail(db, recipe)
+    db.commit()
+    return result
+
+@app.get("/api/recipes/{recipe_id}", response_model=RecipeResponse)
+def get_recipe(recipe_id: int, db: Session = Depends(get_write_db)):
+    """Get a recipe with its ingredients and per-serving totals"""
+    result = recipe_detail(db, get_recipe_or_404(db, recipe_id))
+    db.commit()
+    return result
+
+@app.put("/api/recipes/{recipe_id}/ingredients", response_model=RecipeResponse)
+def update_recipe_ingredients(recipe_id: int, ingredients: List[RecipeIngredientIn], db: Session = Depends(get_write_db)):
+    """Replace a recipe's ingredients"""
+    recipe = get_recipe_or_404(db, recipe_id)
+    try:
+        check_no_cycle(db, recipe.id, [i.recipe_id for i in ingredients if i.recipe_id is not None])
+    except RecipeCycleError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    recipe.ingredients = build_ingredients(db, ingredients)
+    db.flush()
+    # This recipe and every recipe that includes it need recomputing
+    invalidate_recipes(db.connection(), recipe_ids=[recipe.id])
+    db.expire_all()
+    result = recipe_detail(db, get_recipe_or_404(db, recipe_id))
+    db.commit()
+    return result
+
+@app.post("/api/log-recipe", response_model=LogFoodResponse)
+def log_recipe(
+    request: LogRecipeRequest,
+    user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_write_db)
+):
+    """Log servings of a recipe using its memoized per-serving CO2"""
+    recipe = get_recipe_or_404(db, request.recipe_id)
+    try:
+        totals = recipe_totals(db, recipe)
+    except RecipeCycleError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    co2_impact = round(totals["co2_per_serving"] * request.servings, 2)
+    quantity_grams = round(totals["grams_per_serving"] * request.servings, 2)
+    logged_at = datetime.now().isoformat()
+    
+    if write_queue.enabled:
+        db.commit()
+        try:
+            write_queue.submit_food(None, quantity_grams, co2_impact, logged_at, recipe_id=recipe.id,
+                                    user_id=user.id if user else None)
+        except QueueFull:
+            raise HTTPException(status_code=503, detail="Server busy, please retry")
+        return {"id": None, "food_name": recipe.name, "quantity_grams": quantity_grams,
+                "co2_impact": co2_impact, "logged_at": logged_at}
+    
+    log_entry = models.ActivityLog(
+        recipe_id=recipe.id,
+        user_id=user.id if user else None,
+        quantity_grams=quantity_grams,
+        co2_impact=co2_impact,
+        logged_at=logged_at
+    )
+    db.add(log_entry)
+    db.commit()
+    
+    result = {
+        "id": log_entry.id,
+        "food_name": recipe.name,
+        "quantity_grams": quantity_grams,
+        "co2_impact": co2_impact,
+        "logged_at": logged_at
+    }
+    broker.publish(None, "activity", result)
+    return result
+
+# ============ TEAMS API ============
+
+class OrganisationCreate(BaseModel):
+    name: str
+
+class TeamCreate(BaseModel):
+    name: str
+
+class TeamJoin(BaseModel):
+    invite_code: Optional[str] = None
+
+class ImpactTotals(BaseModel):
+    co2_saved: float
+    co2_emitted: float
+    completions: int
+    members: int
+
+class TeamDashboard(BaseModel):
+    id: int
+    name: str
+    org_id: int
+    org_name: str
+    totals: ImpactTotals
+    org_totals: ImpactTotals
+
+class OrganisationDashboard(BaseModel):
+    id: int
+    name: str
+    teams: int
+    totals: ImpactTotals
+
+class LeaderboardEntry(BaseModel):
+    id: int
+    name: str
+    co2_saved: float
+    co2_emitted: float
+    completions: int
+
+def get_org_or_404(db: Session, org_id: int) -> models.Organisation:
+    org = db.get(models.Organisation, org_id)
+    if not org:
+        raise HTTPException(status_code=404, detail="Organisation not found")
+    return org
+
+def get_team_or_404(db: Session, team_id: int) -> models.Team:
+    team = db.get(models.Team, team_id)
+    if not team:
+        raise HTTPException(status_code=404, detail="Team not found")
+    return team
+
+def require_org_member(db: Session, user: models.User, org_id: int):
+    """403 unless the user is on one of the organisation's teams"""
+    _, member_org = teams.parents(db.connection(), user.id)
+    if member_org != org_id:
+        raise HTTPException(status_code=403, detail="Not a member of this organisation")
+
+def leaderboard_entries(rows, names: dict) -> list:
+    return [{"id": r.node_id, "name": names.get(r.node_id, "Unknown"), "co2_saved": r.co2_saved,
+             "co2_emitted": r.co2_emitted, "completions": r.completions} for r in rows]
+
+def user_leaderboard(db: Session, parent: str, parent_id: int, limit: int) -> list:
+    rows = teams.leaderboard(db, "user", parent, parent_id, limit)
+    users = db.query(models.User).filter(models.User.id.in_([r.node_id for r in rows])).all()
+    return leaderboard_entries(rows, {u.id: u.display_name or u.username for u in users})
+
+@app.post("/api/orgs")
+def create_organisation(
+    org_data: OrganisationCreate,
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_write_db)
+):
+    """Create an organisation (admin only); its invite code is shared with employees"""
+    if db.query(models.Organisation).filter(models.Organisation.name == org_data.name).first():
+        raise HTTPException(status_code=400, detail="Organisation already exists")
+    org = models.Organisation(name=org_data.name, invite_code=secrets.token_urlsafe(12))
+    db.add(org)
+    db.flush()
+    teams.add(db.connection(), "org", org.id)
+    db.commit()
+    return {"id": org.id, "name": org.name, "invite_code": org.invite_code}
+
+@app.post("/api/orgs/{org_id}/invite")
+def rotate_invite_code(org_id: int, _: None = Depends(require_admin), db: Session = Depends(get_write_db)):
+    """Issue a new invite code (admin only); the old one stops working"""
+    org = get_org_or_404(db, org_id)
+    org.invite_code = secrets.token_urlsafe(12)
+    db.commit()
+    return {"id": org.id, "invite_code": org.invite_code}
+
+@app.post("/api/orgs/{org_id}/teams")
+def create_team(
+    org_id: int,
+    team_data: TeamCreate,
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_write_db)
+):
+    """Create a team within an organisation (admin only)"""
+    get_org_or_404(db, org_id)
+    team = models.Team(name=team_data.name, org_id=org_id)
+    db.add(team)
+    db.flush()
+    teams.add(db.connection(), "team", team.id, None, org_id)
+    db.commit()
+    return {"id": team.id, "name": team.name, "org_id": org_id}
+
+@app.post("/api/teams/{team_id}/join")
+def join_team(
+    team_id: int,
+    join: Optional[TeamJoin] = None,
+    user: models.User = Depends(require_auth),
+    db: Session = Depends(get_write_db)
+):
+    """Join a team, leaving the current one; the user's totals move with them.
+
+    Members of the team's organisation can move freely; anyone else needs
+    the organisation's invite code.
+    """
+    team = get_team_or_404(db, team_id)
+    _, member_org = teams.parents(db.connection(), user.id)
+    if member_org != team.org_id:
+        org = get_org_or_404(db, team.org_id)
+        code = join.invite_code if join else None
+        if not org.invite_code or not code or not secrets.compare_digest(code.encode(), org.invite_code.encode()):
+            raise HTTPException(status_code=403, detail="Invalid invite code")
+    write_queue.sync_user(user.id)
+    teams.join_team(db, user.id, team)
+    db.commit()
+    return {"team_id": team.id, "org_id": team.org_id}
+
+@app.post("/api/teams/leave")
+def leave_team(
+    user: models.User = Depends(require_auth),
+    db: Session = Depends(get_write_db)
+):
+    """Leave the current team"""
+    write_queue.sync_user(user.id)
+    teams.leave_team(db, user.id)
+    db.commit()
+    return {"team_id": None}
+
+@app.get("/api/teams/{team_id}/dashboard", response_model=TeamDashboard)
+def get_team_dashboard(
+    team_id: int,
+    user: models.User = Depends(require_auth),
+    db: Session = Depends(get_read_db)
+):
+    """Team and organisation totals, read from their rollups (organisation members only)"""
+    team = get_team_or_404(db, team_id)
+    require_org_member(db, user, team.org_id)
+    org = get_org_or_404(db, team.org_id)
+    return {
+        "id": team.id,
+        "name": team.name,
+        "org_id": org.id,
+        "org_name": org.name,
+        "totals": teams.rollup(db, "team", team.id),
+        "org_totals": teams.rollup(db, "org", org.id),
+    }
+
+@app.get("/api/teams/{team_id}/leaderboard", response_model=List[LeaderboardEntry])
+def get_team_leaderboard(
+    team_id: int,
+    limit: int = 10,
+    user: models.User = Depends(require_auth),
+    db: Session = Depends(get_read_db)
+):
+    """Team members ranked by CO2 saved (organisation members only)"""
+    team = get_team_or_404(db, team_id)
+    require_org_member(db, user, team.org_id)
+    return user_leaderboard(db, "team", team_id, min(limit, 100))
+
+@app.get("/api/orgs/{org_id}/dashboard", response_model=OrganisationDashboard)
+def get_org_dashboard(
+    org_id: int,
+    user: models.User = Depends(require_auth),
+    db: Session = Depends(get_read_db)
+):
+    """Organisation totals, read from its rollup (members only)"""
+    org = get_org_or_404(db, org_id)
+    require_org_member(db, user, org_id)
+    team_count = db.query(models.Team).filter(models.Team.org_id == org_id).count()
+    return {"id": org.id, "name": org.name, "teams": team_count, "totals": teams.rollup(db, "org", org.id)}
+
+@app.get("/api/orgs/{org_id}/leaderboard", response_model=List[LeaderboardEntry])
+def get_org_leaderboard(
+    org_id: int,
+    by: str = "teams",
+    limit: int = 10,
+    user: models.User = Depends(require_auth),
+    db: Session = Depends(get_read_db)
+):
+    """An organisation's teams (by=teams) or members (by=members) ranked by CO2 saved (members only)"""
+    get_org_or_404(db, org_id)
+    require_org_member(db, user, org_id)
+    limit = min(limit, 100)
+    if by == "members":
+        return user_leaderboard(db, "org", org_id, limit)
+    if by != "teams":
+        raise HTTPException(status_code=400, detail="by must be 'teams' or 'members'")
+    rows = teams.leaderboard(db, "team", "org", org_id, limit)
+    names = {t.id: t.name for t in db.query(models.Team).filter(models.Team.id.in_([r.node_id for r in rows]))}
+    return leaderboard_entries(rows, names)
+
+# ============ EMISSION FACTORS ============
+
+class EmissionFactorIn(BaseModel):
+    food_id: int
+    co2_per_100g: float
+
+class EmissionFactorRelease(BaseModel):
+    factors: List[EmissionFactorIn]
+    source: Optional[str] = None
+
+class EmissionFactorResponse(BaseModel):
+    version: int
+    co2_per_100g: float
+    source: Optional[str]
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+class RecomputeJobResponse(BaseModel):
+    id: int
+    status: str
+    foods: int
+    recipes: int
+    percent: float
+    last_log_id: int
+    max_log_id: int
+    archive_month: Optional[str]
+    updated_logs: int
+    error: Optional[str]
+    created_at: datetime
+    finished_at: Optional[datetime]
+
+def on_recompute_done(job_id: int):
+    # Historical emissions changed: rebuild analytics now rather than at the next interval
+    if analytics_store:
+        analytics_store.refresh()
+
+recomputer = recompute.Recomputer(engine, SessionLocal, on_done=on_recompute_done)
+
+@app.get("/api/foods/{food_id}/emission-factors", response_model=List[EmissionFactorResponse])
+def get_emission_factors(food_id: int, db: Session = Depends(get_read_db)):
+    """Every emission factor version of a food, newest first"""
+    return db.query(models.EmissionFactor).filter(
+        models.EmissionFactor.food_id == food_id
+    ).order_by(models.EmissionFactor.version.desc()).all()
+
+@app.post("/api/emission-factors", response_model=RecomputeJobResponse)
+def publish_emission_factors(
+    release: EmissionFactorRelease,
+    _: None = Depends(require_admin),
+    db: Session = Depends(get_write_db)
+):
+    """Publish new factors and recompute historical impact in the background (admin only)"""
+    if not release.factors:
+        raise HTTPException(status_code=400, detail="No factors given")
+    if any(f.co2_per_100g < 0 for f in release.factors):
+        raise HTTPException(status_code=400, detail="co2_per_100g must not be negative")
+    try:
+        job = recompute.publish_factors(db, [f.model_dump() for f in release.factors], release.source)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"Food {e.args[0]} not found")
+    db.commit()
+    recomputer.notify()
+    return recompute.progress(job)
+
+@app.get("/api/recompute-jobs/{job_id}", response_model=RecomputeJobResponse)
+def get_recompute_job(job_id: int, db: Session = Depends(get_write_db)):
+    """Progress of a recompute job"""
+    job = db.get(models.RecomputeJob, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return recompute.progress(job)
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Float, DateTime
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, String, Float, DateTime, UniqueConstraint
 from sqlalchemy.orm import relationship
 from database import Base
 from datetime import datetime
@@ -47,10 +47,11 @@ class ChallengeCompletion(Base):
     __tablename__ = "challenge_completions"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     challenge_id = Column(Integer)
-    completed_at = Column(DateTime, default=datetime.utcnow)
+    completed_at = Column(DateTime, default=datetime.utcnow, index=True)  # monthly partition key
     co2_saved = Column(Float)
+    write_key = Column(String, nullable=True, unique=True, index=True)  # write-behind event, for idempotent replay
     
     user = relationship("User", back_populates="challenge_completions")
 
@@ -130,16 +131,146 @@ class Food(Base):
     category = Column(String, index=True)
     is_veg = Column(Boolean, default=False)
     protein = Column(Float)
-    co2_per_100g = Column(Float)
+    co2_per_100g = Column(Float)  # current emission factor
+    factor_version = Column(Integer, default=1)  # NULL on rows from before versioning means 1
     rating = Column(String)  # A, B, C, D, E, F
     origin = Column(String)
     notes = Column(String)
 
+# Recipes / meals composed of foods and other recipes
+class Recipe(Base):
+    __tablename__ = "recipes"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, index=True)
+    servings = Column(Integer, default=1)
+    # Memoized per-serving totals; NULL means stale (an ingredient changed)
+    co2_per_serving = Column(Float, nullable=True)
+    protein_per_serving = Column(Float, nullable=True)
+    grams_per_serving = Column(Float, nullable=True)
+
+    ingredients = relationship("RecipeIngredient", back_populates="recipe",
+                               foreign_keys="RecipeIngredient.recipe_id", cascade="all, delete-orphan")
+
+class RecipeIngredient(Base):
+    __tablename__ = "recipe_ingredients"
+    id = Column(Integer, primary_key=True, index=True)
+    recipe_id = Column(Integer, ForeignKey("recipes.id"), index=True)
+    food_id = Column(Integer, ForeignKey("foods.id"), nullable=True, index=True)
+    sub_recipe_id = Column(Integer, ForeignKey("recipes.id"), nullable=True, index=True)
+    quantity = Column(Float)  # grams of a food, or servings of a sub-recipe
+
+    recipe = relationship("Recipe", back_populates="ingredients", foreign_keys=[recipe_id])
+
 # Activity/Food Logging
 class ActivityLog(Base):
     __tablename__ = "activity_logs"
     id = Column(Integer, primary_key=True, index=True)
     food_id = Column(Integer, ForeignKey("foods.id"))
+    recipe_id = Column(Integer, ForeignKey("recipes.id"), nullable=True)  # set instead of food_id for meals
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=True, index=True)  # set when logged in
     quantity_grams = Column(Float)
     co2_impact = Column(Float)
-    logged_at = Column(String)  # ISO date string
+    factor_version = Column(Integer, nullable=True)  # food emission factor version used for co2_impact
+    write_key = Column(String, nullable=True, unique=True, index=True)  # write-behind event, for idempotent replay
+    logged_at = Column(String, index=True)  # ISO date string, monthly partition key
+
+# Versioned emission factors
+class EmissionFactor(Base):
+    __tablename__ = "emission_factors"
+    id = Column(Integer, primary_key=True, index=True)
+    food_id = Column(Integer, ForeignKey("foods.id"), index=True)
+    version = Column(Integer)
+    co2_per_100g = Column(Float)
+    source = Column(String, nullable=True)  # dataset the factor came from
+    created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (UniqueConstraint("food_id", "version"),)
+
+class RecomputeJob(Base):
+    """Re-derivation of historical co2_impact after emission factors change"""
+    __tablename__ = "recompute_jobs"
+    id = Column(Integer, primary_key=True, index=True)
+    status = Column(String, default="pending", index=True)  # pending, running, done, failed
+    food_ids = Column(String)  # JSON list of foods whose factor changed
+    recipe_ids = Column(String)  # JSON list of recipes that include them
+    max_log_id = Column(Integer)  # later logs already use the new factors
+    last_log_id = Column(Integer, default=0)  # resume point in activity_logs
+    archive_month = Column(String, nullable=True)  # last archived month rewritten
+    updated_logs = Column(Integer, default=0)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+# Teams and organisations
+class Organisation(Base):
+    __tablename__ = "organisations"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, index=True)
+    invite_code = Column(String, nullable=True)  # needed to join the organisation's teams
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class Team(Base):
+    __tablename__ = "teams"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String)
+    org_id = Column(Integer, ForeignKey("organisations.id"), index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class TeamMembership(Base):
+    __tablename__ = "team_memberships"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)  # one team per user
+    team_id = Column(Integer, ForeignKey("teams.id"), index=True)
+    joined_at = Column(DateTime, default=datetime.utcnow)
+
+class ImpactRollup(Base):
+    """Running totals per user, team and organisation, updated on every event"""
+    __tablename__ = "impact_rollups"
+    node_type = Column(String, primary_key=True)  # "user", "team" or "org"
+    node_id = Column(Integer, primary_key=True)
+    team_id = Column(Integer, nullable=True)  # parent team/org, for leaderboards
+    org_id = Column(Integer, nullable=True)
+    co2_saved = Column(Float, default=0)
+    co2_emitted = Column(Float, default=0)
+    completions = Column(Integer, default=0)
+    members = Column(Integer, default=0)
+    __table_args__ = (
+        Index("ix_impact_rollups_team_saved", "node_type", "team_id", "co2_saved"),
+        Index("ix_impact_rollups_org_saved", "node_type", "org_id", "co2_saved"),
+    )
+
+# Delta sync
+class ChangeLog(Base):
+    """Latest change to each row of the synced tables, in commit order"""
+    __tablename__ = "change_log"
+    version = Column(Integer, primary_key=True)  # AUTOINCREMENT: never reused
+    scope = Column(String)  # "catalog" or "user:<id>"
+    entity = Column(String)  # table name
+    key = Column(String)  # primary key of the row
+    op = Column(String)  # "upsert" or "delete"
+    data = Column(String, nullable=True)  # JSON row for upserts
+    changed_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        UniqueConstraint("entity", "key"),
+        Index("ix_change_log_scope_version", "scope", "version"),
+        {"sqlite_autoincrement": True},
+    )
+
+# Shared state for multi-worker deployments
+class AuthToken(Base):
+    __tablename__ = "auth_tokens"
+    token = Column(String, primary_key=True)  # SHA-256 hex of the bearer token
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=True, index=True)
+
+class StateVersion(Base):
+    __tablename__ = "state_versions"
+    name = Column(String, primary_key=True)  # e.g. "dashboard", "user:42"
+    version = Column(Integer, default=0)
+
+# Snapshot restore
+class DatabaseMeta(Base):
+    """Which database file this is and how far it has advanced (a single row)"""
+    __tablename__ = "db_meta"
+    id = Column(Integer, primary_key=True)
+    lineage = Column(String)  # random id given when the file was first initialised
+    generation = Column(Integer, default=0)  # bumped by every transaction that changes rows
@@ -0,0 +1,272 @@
+"""Admission control for write requests.
+
+An ASGI middleware in front of every POST/PUT/PATCH/DELETE:
+
+* a token bucket per client, keyed on the user a valid bearer token belongs
+  to, or else the client IP, answering 429 when empty;
+* a global cap on in-flight writes, answering 503 when exceeded;
+* fast 503s while the write-behind queue is close to saturation.
+
+Buckets live in memory (O(1) per request; least recently used buckets are
+forgotten once they have refilled).
+With RATE_LIMIT_SHARED=1 they live in a small local SQLite file instead so
+all workers on the host share one budget per client.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from starlette.concurrency import run_in_threadpool
+
+import shared_state
+from database import SessionLocal
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_RATE = float(os.getenv("RATE_LIMIT_RATE", "5"))  # tokens per second
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "20"))
+RATE_LIMIT_MAX_INFLIGHT = int(os.getenv("RATE_LIMIT_MAX_INFLIGHT", "64"))
+RATE_LIMIT_QUEUE_SHED = float(os.getenv("RATE_LIMIT_QUEUE_SHED", "0.9"))  # fraction of write queue
+RATE_LIMIT_SHARED = os.getenv("RATE_LIMIT_SHARED", "0") == "1"
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "./ratelimit.db")
+# Proxies in front of the app that append to X-Forwarded-For (0 = use the peer address)
+RATE_LIMIT_PROXY_HOPS = int(os.getenv("RATE_LIMIT_PROXY_HOPS", "0"))
+TOKEN_CACHE_TTL = 60.0  # seconds a token -> user lookup is reused
+MAX_KEYS = 10000
+
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+
+class MemoryBuckets:
+    def __init__(self, rate=RATE_LIMIT_RATE, burst=RATE_LIMIT_BURST, max_keys=MAX_KEYS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> [tokens, last refill]
+        self._lock = threading.Lock()
+
+    def take(self, key: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+                self._evict(now)
+            else:
+                self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+
+    def _evict(self, now: float):
+        # Only forget buckets that have refilled, so a flood of new keys
+        # can't reset a client that is being limited
+        while len(self._buckets) > self.max_keys:
+            tokens, updated = next(iter(self._buckets.values()))
+            if tokens + (now - updated) * self.rate < self.burst:
+                break
+            self._buckets.popitem(last=False)
+
+
+class SharedBuckets:
+    """Token buckets in a local SQLite file, shared by every worker on the host"""
+
+    def __init__(self, path=RATE_LIMIT_STORE, rate=RATE_LIMIT_RATE, burst=RATE_LIMIT_BURST):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self._local = threading.local()
+        self._calls = 0
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets "
+                "(key TEXT PRIMARY KEY, tokens REAL, updated REAL, allowed INTEGER)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=1.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")  # losing a bucket on crash is harmless
+            self._local.conn = conn
+        return conn
+
+    def take(self, key: str) -> bool:
+        # Refill, check and consume in one atomic statement
+        refilled = "MIN(:burst, tokens + (:now - updated) * :rate)"
+        row = self._connect().execute(
+            "INSERT INTO buckets (key, tokens, updated, allowed) VALUES (:key, :burst - 1, :now, 1) "
+            "ON CONFLICT(key) DO UPDATE SET "
+            f"tokens = CASE WHEN {refilled} >= 1 THEN {refilled} - 1 ELSE {refilled} END, "
+            f"allowed = {refilled} >= 1, "
+            "updated = :now "
+            "RETURNING allowed",
+            {"key": key, "now": time.time(), "rate": self.rate, "burst": self.burst}
+        ).fetchone()
+        self._calls += 1
+        if self._calls % 1000 == 0:
+            # Full buckets carry no state worth keeping
+            self._connect().execute("DELETE FROM buckets WHERE updated < ?", (time.time() - 3600,))
+        return bool(row[0])
+
+
+class RateLimitMetrics:
+    def __init__(self):
+        self.admitted = 0
+        self.rejected = {"rate_limited": 0, "overloaded": 0, "queue_saturated": 0}
+        self.inflight = 0
+        self._lock = threading.Lock()
+
+    def try_admit(self, max_inflight: int) -> bool:
+        with self._lock:
+            if self.inflight >= max_inflight:
+                return False
+            self.inflight += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def reject(self, reason: str):
+        with self._lock:
+            self.rejected[reason] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"admitted": self.admitted, "inflight": self.inflight, "rejected": dict(self.rejected)}
+
+
+metrics = RateLimitMetrics()
+
+
+class TokenUsers:
+    """Bearer token -> user id (None if invalid), cached briefly"""
+
+    def __init__(self, ttl=TOKEN_CACHE_TTL, max_keys=MAX_KEYS):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._users = OrderedDict()  # token -> (user id, expiry)
+        self._lock = threading.Lock()
+
+    def cached(self, token: str) -> bool:
+        with self._lock:
+            entry = self._users.get(token)
+            return entry is not None and entry[1] > time.monotonic()
+
+    def get(self, token: str):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._users.get(token)
+            if entry is not None and entry[1] > now:
+                self._users.move_to_end(token)
+                return entry[0]
+        db = SessionLocal()
+        try:
+            user_id = shared_state.lookup_token(db, token)
+        finally:
+            db.close()
+        with self._lock:
+            self._users[token] = (user_id, now + self.ttl)
+            self._users.move_to_end(token)
+            while len(self._users) > self.max_keys:
+                self._users.popitem(last=False)
+        return user_id
+
+
+token_users = TokenUsers()
+
+
+def bearer_token(scope):
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            auth = value.decode("latin-1")
+            if auth[:7].lower() == "bearer " and auth[7:].strip():
+                return auth[7:].strip()
+    return None
+
+def client_ip(scope) -> str:
+    """Peer address, or the one our own proxies recorded in X-Forwarded-For.
+
+    Only the entries appended by the last RATE_LIMIT_PROXY_HOPS proxies are
+    trusted; anything before them is whatever the client sent.
+    """
+    if RATE_LIMIT_PROXY_HOPS:
+        hops = [hop.strip() for name, value in scope["headers"] if name == b"x-forwarded-for"
+                for hop in value.decode("latin-1").split(",") if hop.strip()]
+        if len(hops) >= RATE_LIMIT_PROXY_HOPS:
+            return hops[-RATE_LIMIT_PROXY_HOPS]
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+def client_key(scope) -> str:
+    """The user behind a valid bearer token, otherwise the client IP"""
+    token = bearer_token(scope)
+    user_id = token_users.get(token) if token else None
+    if user_id is not None:
+        return f"user:{user_id}"
+    return "ip:" + client_ip(scope)
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, write_queue=None, enabled=RATE_LIMIT_ENABLED,
+                 max_inflight=RATE_LIMIT_MAX_INFLIGHT, queue_shed=RATE_LIMIT_QUEUE_SHED):
+        self.app = app
+        self.enabled = enabled
+        self.write_queue = write_queue
+        self.max_inflight = max_inflight
+        self.queue_shed = queue_shed
+        self.buckets = SharedBuckets() if RATE_LIMIT_SHARED else MemoryBuckets()
+
+    async def __call__(self, scope, receive, send):
+        if not self.enabled or scope["type"] != "http" or scope["method"] not in WRITE_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        if self._queue_saturated():
+            metrics.reject("queue_saturated")
+            await self._reject(send, 503, "Server busy, please retry", retry_after=1)
+            return
+        token = bearer_token(scope)
+        if token and not token_users.cached(token):
+            # Resolve the token off the event loop; client_key then hits the cache
+            await run_in_threadpool(token_users.get, token)
+        if not self.buckets.take(client_key(scope)):
+            metrics.reject("rate_limited")
+            await self._reject(send, 429, "Too many requests", retry_after=max(1, round(1 / self.buckets.rate)))
+            return
+
+        if not metrics.try_admit(self.max_inflight):
+            metrics.reject("overloaded")
+            await self._reject(send, 503, "Server busy, please retry", retry_after=1)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            metrics.release()
+
+    def _queue_saturated(self) -> bool:
+        if not self.write_queue or not self.write_queue.enabled:
+            return False
+        return self.write_queue.stats()["pending"] >= self.write_queue.max_queue * self.queue_shed
+
+    @staticmethod
+    async def _reject(send, status: int, detail: str, retry_after: int):
+        body = json.dumps({"detail": detail}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(retry_after).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,127 @@
+"""Recipe totals with memoization.
+
+A recipe's per-serving CO2, protein and weight are computed once from its
+ingredients (foods, or servings of other recipes) and stored on the recipe
+row. They are cleared whenever an ingredient food's `co2_per_100g` or
+`protein` changes, walking up to every recipe that includes it, so logging a
+recipe is normally a single row lookup.
+"""
+from sqlalchemy import event, inspect, update
+from sqlalchemy.orm import Session
+
+import models
+
+
+class RecipeCycleError(Exception):
+    """Raised when recipes include each other"""
+
+
+# ============ COMPUTATION ============
+
+def recipe_totals(db, recipe: models.Recipe) -> dict:
+    """Per-serving totals, computing and memoizing any that are stale"""
+    if recipe.co2_per_serving is None:
+        _compute(db, recipe, visiting=set())
+    return {
+        "co2_per_serving": recipe.co2_per_serving,
+        "protein_per_serving": recipe.protein_per_serving,
+        "grams_per_serving": recipe.grams_per_serving,
+    }
+
+def _compute(db, recipe: models.Recipe, visiting: set):
+    """Depth-first over sub-recipes, resolving dependencies before dependants"""
+    if recipe.id in visiting:
+        raise RecipeCycleError(f"Recipe '{recipe.name}' includes itself")
+    visiting.add(recipe.id)
+
+    co2 = protein = grams = 0.0
+    food_ids = [i.food_id for i in recipe.ingredients if i.food_id is not None]
+    foods = {f.id: f for f in db.query(models.Food).filter(models.Food.id.in_(food_ids))} if food_ids else {}
+    for ingredient in recipe.ingredients:
+        if ingredient.food_id is not None:
+            food = foods[ingredient.food_id]
+            co2 += food.co2_per_100g * ingredient.quantity / 100
+            protein += (food.protein or 0) * ingredient.quantity / 100
+            grams += ingredient.quantity
+        else:
+            sub = db.get(models.Recipe, ingredient.sub_recipe_id)
+            if sub.co2_per_serving is None:
+                _compute(db, sub, visiting)
+            co2 += sub.co2_per_serving * ingredient.quantity
+            protein += sub.protein_per_serving * ingredient.quantity
+            grams += sub.grams_per_serving * ingredient.quantity
+
+    visiting.discard(recipe.id)
+    servings = recipe.servings or 1
+    recipe.co2_per_serving = round(co2 / servings, 4)
+    recipe.protein_per_serving = round(protein / servings, 4)
+    recipe.grams_per_serving = round(grams / servings, 4)
+
+
+def check_no_cycle(db, recipe_id: int, sub_recipe_ids):
+    """Raise if any sub-recipe (transitively) includes recipe_id"""
+    stack, seen = list(sub_recipe_ids), set()
+    while stack:
+        current = stack.pop()
+        if current == recipe_id:
+            raise RecipeCycleError("Recipe would include itself")
+        if current in seen:
+            continue
+        seen.add(current)
+        stack.extend(row[0] for row in db.query(models.RecipeIngredient.sub_recipe_id).filter(
+            models.RecipeIngredient.recipe_id == current,
+            models.RecipeIngredient.sub_recipe_id.isnot(None)
+        ))
+
+
+# ============ INVALIDATION ============
+
+def dependent_recipes(connection, recipe_ids=(), food_ids=()) -> set:
+    """Recipes using these foods/recipes, their parents, and the given recipes"""
+    ingredients = models.RecipeIngredient.__table__
+    stale = set(recipe_ids)
+    if food_ids:
+        stale.update(row[0] for row in connection.execute(
+            ingredients.select().with_only_columns(ingredients.c.recipe_id)
+            .where(ingredients.c.food_id.in_(list(food_ids)))
+        ))
+    frontier = set(stale)
+    while frontier:
+        parents = {row[0] for row in connection.execute(
+            ingredients.select().with_only_columns(ingredients.c.recipe_id)
+            .where(ingredients.c.sub_recipe_id.in_(list(frontier)))
+        )} - stale
+        stale |= parents
+        frontier = parents
+    return stale
+
+def invalidate_recipes(connection, recipe_ids=(), food_ids=()):
+    """Clear memoized totals for recipes using these foods/recipes, and their parents"""
+    recipes = models.Recipe.__table__
+    stale = dependent_recipes(connection, recipe_ids, food_ids)
+    if stale:
+        connection.execute(update(recipes).where(recipes.c.id.in_(list(stale))).values(
+            co2_per_serving=None, protein_per_serving=None, grams_per_serving=None
+        ))
+    return stale
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_on_food_change(session, flush_context):
+    changed = [
+        obj.id for obj in session.dirty
+        if isinstance(obj, models.Food) and any(
+            inspect(obj).attrs[name].history.has_changes() for name in ("co2_per_100g", "protein")
+        )
+    ]
+    if changed:
+        stale = invalidate_recipes(session.connection(), food_ids=changed)
+        session.info.setdefault("stale_recipes", set()).update(stale)
+
+@event.listens_for(Session, "after_flush_postexec")
+def _expire_stale_recipes(session, flush_context):
+    # Drop in-memory copies so this session sees the cleared totals
+    stale = session.info.pop("stale_recipes", None)
+    if stale:
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, models.Recipe) and obj.id in stale:
+                session.expire(obj, ["co2_per_serving", "protein_per_serving", "grams_per_serving"])
@@ -0,0 +1,360 @@
+"""Versioned emission factors and historical recomputation.
+
+`publish_factors` records a new version of each food's emission factor,
+makes it the food's current `co2_per_100g` and queues a RecomputeJob. A
+background worker then re-derives `co2_impact` for older activity logs of
+those foods, and of recipes that include them. It walks the activity_logs
+primary key in ranges of RECOMPUTE_CHUNK ids. Each range is one short
+transaction:
+
+* one set-based `UPDATE ... FROM foods` (or `FROM recipes`) that skips rows
+  whose value doesn't change, with `RETURNING` feeding the change log;
+* the matching `co2_emitted` deltas added to user/team/org rollups;
+* the job's resume point.
+
+The worker pauses RECOMPUTE_SLEEP between ranges so live writes interleave.
+After the live table, archived months are rewritten one file at a time. Each
+new file is staged next to the old one and moved into place only after the
+month's rollup deltas, change-log entries and resume point commit.
+
+Logs committed after publishing but computed with the old factor (requests
+in flight, the write-behind queue) get ids above the job's `max_log_id`. A
+final sweep carries the same ranges on up to the newest log.
+A restarted job carries on from its last committed range, month or sweep range.
+
+    python recompute.py                        # run queued jobs
+    python recompute.py publish release.json   # publish factors, then run
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import func, text
+
+import archive
+import change_log
+import models
+import teams
+from recipes import dependent_recipes, recipe_totals
+
+RECOMPUTE_CHUNK = int(os.getenv("RECOMPUTE_CHUNK", "5000"))  # activity log ids per transaction
+RECOMPUTE_SLEEP = float(os.getenv("RECOMPUTE_SLEEP", "0.05"))  # seconds between chunks
+RECOMPUTE_POLL = float(os.getenv("RECOMPUTE_POLL", "5"))  # seconds between checks for new jobs
+RECOMPUTE_LOCK = os.getenv("RECOMPUTE_LOCK", "./recompute.lock")
+
+LOG_COLUMNS = "id, food_id, recipe_id, user_id, quantity_grams, co2_impact, factor_version, logged_at"
+FOOD_CO2 = "ROUND(foods.co2_per_100g * activity_logs.quantity_grams / 100, 2)"
+RECIPE_CO2 = "ROUND(recipes.co2_per_serving * activity_logs.quantity_grams / recipes.grams_per_serving, 2)"
+
+
+# ============ PUBLISHING FACTORS ============
+
+def publish_factors(db, factors: list, source=None) -> models.RecomputeJob:
+    """Add a factor version per {food_id, co2_per_100g} and queue a recompute; the caller commits"""
+    food_ids = []
+    for factor in factors:
+        food = db.get(models.Food, factor["food_id"])
+        if food is None:
+            raise KeyError(factor["food_id"])
+        latest = db.query(func.max(models.EmissionFactor.version)).filter(
+            models.EmissionFactor.food_id == food.id
+        ).scalar() or 0
+        version = max(latest, food.factor_version or 1) + 1
+        db.add(models.EmissionFactor(food_id=food.id, version=version,
+                                     co2_per_100g=factor["co2_per_100g"], source=source))
+        food.co2_per_100g = factor["co2_per_100g"]
+        food.factor_version = version
+        food_ids.append(food.id)
+    db.flush()  # also clears memoized totals of recipes using these foods
+    recipe_ids = dependent_recipes(db.connection(), food_ids=food_ids)
+    job = models.RecomputeJob(
+        food_ids=json.dumps(sorted(food_ids)),
+        recipe_ids=json.dumps(sorted(recipe_ids)),
+        max_log_id=db.query(func.max(models.ActivityLog.id)).scalar() or 0,
+    )
+    db.add(job)
+    db.flush()
+    return job
+
+def backfill_versions(connection) -> int:
+    """Record each food's current factor as version 1 (or its current version)"""
+    return connection.execute(text(
+        "INSERT INTO emission_factors (food_id, version, co2_per_100g, source, created_at) "
+        "SELECT id, COALESCE(factor_version, 1), co2_per_100g, 'initial catalog', :now FROM foods"
+    ), {"now": datetime.utcnow()}).rowcount
+
+def progress(job: models.RecomputeJob) -> dict:
+    return {
+        "id": job.id,
+        "status": job.status,
+        "foods": len(json.loads(job.food_ids)),
+        "recipes": len(json.loads(job.recipe_ids)),
+        "percent": 100.0 if job.status == "done" else
+                   round(min(job.last_log_id or 0, job.max_log_id) / job.max_log_id * 100, 1) if job.max_log_id else 0.0,
+        "last_log_id": job.last_log_id,
+        "max_log_id": job.max_log_id,
+        "archive_month": job.archive_month,
+        "updated_logs": job.updated_logs,
+        "error": job.error,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+    }
+
+
+# ============ LIVE TABLE ============
+
+def _apply_deltas(connection, rows):
+    """Add the co2_emitted changes of recomputed rows to user/team/org rollups"""
+    deltas = {}
+    for row in rows:
+        if row["user_id"] is not None:
+            deltas[row["user_id"]] = deltas.get(row["user_id"], 0) + row["co2_impact"] - row["old_co2"]
+    for user_id, delta in deltas.items():
+        teams.add_user_event(connection, user_id, co2_emitted=delta)
+
+def recompute_chunk(connection, job: dict, low: int, high: int) -> int:
+    """Re-derive co2_impact for logs with low < id <= high; returns rows changed"""
+    params = {"low": low, "high": high, "food_ids": job["food_ids"], "recipe_ids": job["recipe_ids"]}
+    changed = []
+    for source, co2, join, stale in (
+        ("foods", FOOD_CO2,
+         "foods.id = activity_logs.food_id AND activity_logs.food_id IN (SELECT value FROM json_each(:food_ids))",
+         f"activity_logs.co2_impact IS NOT {FOOD_CO2} "
+         "OR activity_logs.factor_version IS NOT COALESCE(foods.factor_version, 1)"),
+        ("recipes", RECIPE_CO2,
+         "recipes.id = activity_logs.recipe_id AND activity_logs.recipe_id IN (SELECT value FROM json_each(:recipe_ids)) "
+         "AND recipes.co2_per_serving IS NOT NULL AND recipes.grams_per_serving > 0",
+         f"activity_logs.co2_impact IS NOT {RECIPE_CO2}"),
+    ):
+        # Only rows whose value changes, so unchanged logs cost no writes
+        where = f"{join} AND activity_logs.id > :low AND activity_logs.id <= :high AND ({stale})"
+        # Old values for rollup deltas, read in the same transaction as the update
+        old = dict(connection.execute(text(
+            f"SELECT activity_logs.id, activity_logs.co2_impact FROM activity_logs, {source} WHERE {where}"
+        ), params).fetchall())
+        if not old:
+            continue
+        version = ", factor_version = COALESCE(foods.factor_version, 1)" if source == "foods" else ""
+        rows = connection.execute(text(
+            f"UPDATE activity_logs SET co2_impact = {co2}{version} FROM {source} WHERE {where} "
+            f"RETURNING {LOG_COLUMNS}"
+        ), params).mappings().all()
+        changed.extend({**row, "old_co2": old.get(row["id"]) or 0} for row in rows)
+    _apply_deltas(connection, changed)
+    _record_changes(connection, changed)
+    return len(changed)
+
+def _record_changes(connection, rows):
+    """Send recomputed rows to the delta-sync log"""
+    change_log.record(connection, "activity_logs", [
+        (change_log.scope_for("user_id", row), row["id"], "upsert",
+         {k: v for k, v in row.items() if k != "old_co2"})
+        for row in rows
+    ])
+
+
+# ============ ARCHIVED MONTHS ============
+
+def staged_path(job_id: int, month: str) -> str:
+    return archive.partition_path("activity_logs", month) + f".job{job_id}"
+
+def recompute_month(connection, month: str, factors: dict, recipes: dict, staged: str) -> int:
+    """Write a recomputed copy of one archived month to `staged`; returns rows changed.
+
+    Rollup deltas and change-log entries go into the caller's transaction;
+    the caller installs the staged file once that commits.
+    """
+    changed = []
+    for row in archive.load_partition("activity_logs", month):
+        if row.get("recipe_id") is not None:
+            totals = recipes.get(row["recipe_id"])
+            if not totals or not totals[1]:
+                continue
+            co2 = round(totals[0] * row["quantity_grams"] / totals[1], 2)
+            version = row.get("factor_version")
+        elif row["food_id"] in factors:
+            co2 = round(factors[row["food_id"]][0] * row["quantity_grams"] / 100, 2)
+            version = factors[row["food_id"]][1]
+        else:
+            continue
+        if co2 != row["co2_impact"] or version != row.get("factor_version"):
+            changed.append({**row, "co2_impact": co2, "factor_version": version, "old_co2": row["co2_impact"] or 0})
+    if changed:
+        changed = [{**row, "user_id": row.get("user_id")} for row in changed]
+        archive.write_partition("activity_logs", month, [
+            {k: v for k, v in row.items() if k != "old_co2"} for row in changed
+        ], path=staged)
+        _apply_deltas(connection, changed)
+        _record_changes(connection, changed)
+    return len(changed)
+
+
+# ============ JOB RUNNER ============
+
+def run_job(engine, session_factory, job_id: int, stop=None):
+    """Run (or resume) a job to completion unless `stop` is set"""
+    db = session_factory()
+    try:
+        job = db.get(models.RecomputeJob, job_id)
+        job.status = "running"
+        # Bring memoized recipe totals up to date before copying them into logs
+        for recipe_id in json.loads(job.recipe_ids):
+            recipe = db.get(models.Recipe, recipe_id)
+            if recipe is not None:
+                recipe_totals(db, recipe)
+        db.commit()
+        spec = {"food_ids": job.food_ids, "recipe_ids": job.recipe_ids}
+        last, max_log_id, month_done = job.last_log_id or 0, job.max_log_id, job.archive_month
+    finally:
+        db.close()
+
+    jobs = models.RecomputeJob.__table__
+
+    def recompute_range(last, end):
+        """Chunks from `last` up to `end`; returns the resume point reached"""
+        while last < end:
+            if stop is not None and stop.is_set():
+                return last
+            high = min(last + RECOMPUTE_CHUNK, end)
+            with engine.begin() as conn:
+                count = recompute_chunk(conn, spec, last, high)
+                conn.execute(jobs.update().where(jobs.c.id == job_id).values(
+                    last_log_id=high, updated_logs=jobs.c.updated_logs + count
+                ))
+            last = high
+            time.sleep(RECOMPUTE_SLEEP)
+        return last
+
+    last = recompute_range(last, max_log_id)
+    if last < max_log_id:
+        return
+
+    food_ids = set(json.loads(spec["food_ids"]))
+    recipe_ids = set(json.loads(spec["recipe_ids"]))
+    with engine.connect() as conn:
+        factors = {row[0]: (row[1], row[2] or 1) for row in conn.execute(text(
+            "SELECT id, co2_per_100g, factor_version FROM foods"
+        )) if row[0] in food_ids}
+        recipes = {row[0]: (row[1], row[2]) for row in conn.execute(text(
+            "SELECT id, co2_per_serving, grams_per_serving FROM recipes WHERE co2_per_serving IS NOT NULL"
+        )) if row[0] in recipe_ids}
+    for month in archive.archived_months("activity_logs"):
+        staged = staged_path(job_id, month)
+        if month_done and month <= month_done:
+            if os.path.exists(staged):
+                # Committed before a crash, but not yet moved into place
+                with archive.archive_lock():
+                    archive.install_partition("activity_logs", month, staged)
+            continue
+        if stop is not None and stop.is_set():
+            return
+        # Archival can't merge rows into the month while its copy is staged
+        with archive.archive_lock():
+            if os.path.exists(staged):
+                os.remove(staged)  # left by a run that stopped before committing
+            with engine.begin() as conn:
+                count = recompute_month(conn, month, factors, recipes, staged)
+                conn.execute(jobs.update().where(jobs.c.id == job_id).values(
+                    archive_month=month, updated_logs=jobs.c.updated_logs + count
+                ))
+            if count:
+                archive.install_partition("activity_logs", month, staged)
+        time.sleep(RECOMPUTE_SLEEP)
+
+    # Logs committed after publishing with the old factor
+    with engine.connect() as conn:
+        newest = conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM activity_logs")).scalar()
+    if recompute_range(last, newest) < newest:
+        return
+
+    with engine.begin() as conn:
+        conn.execute(jobs.update().where(jobs.c.id == job_id).values(
+            status="done", finished_at=datetime.utcnow()
+        ))
+
+
+class Recomputer:
+    """Runs pending jobs in the background; a lock file keeps it to one process"""
+
+    def __init__(self, engine, session_factory, on_done=None):
+        self.engine = engine
+        self.session_factory = session_factory
+        self.on_done = on_done
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name="recompute", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def notify(self):
+        """A job was queued"""
+        self._wake.set()
+
+    def run_pending(self) -> int:
+        """Run every unfinished job, oldest first; returns how many finished"""
+        with open(RECOMPUTE_LOCK, "w") as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return 0  # another worker is recomputing
+            finished = 0
+            while not self._stop.is_set():
+                db = self.session_factory()
+                try:
+                    job = db.query(models.RecomputeJob).filter(
+                        models.RecomputeJob.status.in_(["pending", "running"])
+                    ).order_by(models.RecomputeJob.id).first()
+                    job_id = job.id if job else None
+                finally:
+                    db.close()
+                if job_id is None:
+                    break
+                try:
+                    run_job(self.engine, self.session_factory, job_id, self._stop)
+                except Exception as e:
+                    print(f"Recompute job {job_id} failed: {e}")
+                    with self.engine.begin() as conn:
+                        jobs = models.RecomputeJob.__table__
+                        conn.execute(jobs.update().where(jobs.c.id == job_id).values(status="failed", error=str(e)))
+                    continue
+                if not self._stop.is_set():
+                    finished += 1
+                    if self.on_done:
+                        self.on_done(job_id)
+            return finished
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_pending()
+            except Exception as e:
+                print(f"Recompute failed: {e}")
+            self._wake.wait(RECOMPUTE_POLL)
+            self._wake.clear()
+
+
+if __name__ == "__main__":
+    import sys
+
+    from database import SessionLocal, engine, init_schema
+
+    init_schema()
+    if sys.argv[1:2] == ["publish"]:
+        # python recompute.py publish release.json  ({"factors": [...], "source": "..."})
+        with open(sys.argv[2]) as f:
+            release = json.load(f)
+        db = SessionLocal()
+        try:
+            job = publish_factors(db, release["factors"], release.get("source"))
+            db.commit()
+            print(f"Queued recompute job {job.id}")
+        finally:
+            db.close()
+    print(f"Finished {Recomputer(engine, SessionLocal).run_pending()} recompute jobs")
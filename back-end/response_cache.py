@@ -0,0 +1,120 @@
+"""In-memory HTTP response cache for the global dashboard endpoints.
+
+Responses are stored as pre-serialized JSON bytes keyed on route and a data
+version counter. The counter is bumped whenever a commit touches one of the
+cached tables, so entries never outlive the data they were built from. The
+bump is mirrored to `state_versions` so other worker processes (and
+init_db.py) can invalidate this cache too.
+"""
+import hashlib
+import os
+import threading
+import time
+
+from fastapi import Response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from shared_state import POLL_INTERVAL, VersionWatcher, bump
+
+CACHE_MAX_AGE = int(os.getenv("CACHE_MAX_AGE", "60"))  # seconds
+CACHE_STALE_WHILE_REVALIDATE = int(os.getenv("CACHE_STALE_WHILE_REVALIDATE", "300"))  # seconds
+
+
+class ResponseCache:
+    def __init__(self, shared_name="dashboard", max_age=CACHE_MAX_AGE,
+                 stale_while_revalidate=CACHE_STALE_WHILE_REVALIDATE):
+        self.shared_name = shared_name
+        self.cache_control = f"public, max-age={max_age}, stale-while-revalidate={stale_while_revalidate}"
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}  # route -> (version, body, etag)
+        self._lock = threading.Lock()
+        self._tables = set()
+        self._watcher = VersionWatcher()
+        self._last_poll = 0.0
+
+    def watch(self, *model_classes):
+        """Invalidate the cache when a commit writes to these models' tables"""
+        self._tables.update(m.__tablename__ for m in model_classes)
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def respond(self, request, route: str, build) -> Response:
+        """Serve route from cache, calling build() -> bytes on a miss"""
+        entry = self._get_or_build(route, build)
+        _, body, etag = entry
+        headers = {"Cache-Control": self.cache_control, "ETag": etag}
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def prime(self, route: str, build):
+        """Fill the cache for route ahead of the first request"""
+        self._get_or_build(route, build)
+
+    def _get_or_build(self, route: str, build):
+        self._poll_shared_version()
+        with self._lock:
+            entry = self._entries.get(route)
+            version = self.version
+        if entry and entry[0] == version:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        body = build()
+        entry = (version, body, '"%s"' % hashlib.sha1(body).hexdigest())
+        with self._lock:
+            if self.version == version:
+                self._entries[route] = entry
+        return entry
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"version": self.version, "entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _poll_shared_version(self):
+        now = time.monotonic()
+        if now - self._last_poll < POLL_INTERVAL:
+            return
+        self._last_poll = now
+        if self._watcher.changed([self.shared_name]):
+            self.invalidate()
+
+    # ---- SQLAlchemy hooks ----
+
+    def _after_flush(self, session, flush_context):
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if getattr(obj, "__tablename__", None) in self._tables:
+                session.info["response_cache_dirty"] = True
+                return
+
+    def _after_commit(self, session):
+        if session.info.pop("response_cache_dirty", False):
+            self.invalidate()
+            self._watcher.note(self.shared_name, bump(self.shared_name))
+
+    def _after_rollback(self, session):
+        session.info.pop("response_cache_dirty", None)
+
+    def install(self):
+        event.listen(Session, "after_flush", self._after_flush)
+        event.listen(Session, "after_commit", self._after_commit)
+        event.listen(Session, "after_rollback", self._after_rollback)
+
+
+def etag_matches(if_none_match, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return etag in tags or f"W/{etag}" in tags
+
+
+response_cache = ResponseCache()
+response_cache.install()
@@ -0,0 +1,104 @@
+"""State shared between worker processes through the database.
+
+Auth tokens live in `auth_tokens` so any worker can authenticate a request.
+Only a SHA-256 of each token is stored, with an expiry, so a copy of the
+database (or a snapshot) can't be used to log in.
+`state_versions` holds counters that a worker bumps after a write; other
+workers poll them to invalidate their local caches and live streams.
+"""
+import hashlib
+import os
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+import models
+from database import engine
+
+MULTI_WORKER = os.getenv("MULTI_WORKER", "0") == "1"
+POLL_INTERVAL = float(os.getenv("SHARED_STATE_POLL_INTERVAL", "1.0"))  # seconds
+TOKEN_TTL_DAYS = float(os.getenv("TOKEN_TTL_DAYS", "30"))
+
+
+# ============ AUTH TOKENS ============
+
+def token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def store_token(db, token: str, user_id: int):
+    db.add(models.AuthToken(token=token_hash(token), user_id=user_id,
+                            expires_at=datetime.utcnow() + timedelta(days=TOKEN_TTL_DAYS)))
+    db.commit()
+
+def lookup_token(db, token: str):
+    """Return the user id for an unexpired token, or None"""
+    row = db.query(models.AuthToken.user_id).filter(
+        models.AuthToken.token == token_hash(token), models.AuthToken.expires_at > datetime.utcnow()
+    ).first()
+    return row[0] if row else None
+
+def revoke_token(db, token: str):
+    db.query(models.AuthToken).filter(models.AuthToken.token == token_hash(token)).delete()
+    db.commit()
+
+def purge_tokens(db) -> int:
+    """Delete expired tokens, and plaintext ones stored before hashing (no expiry)"""
+    count = db.query(models.AuthToken).filter(
+        models.AuthToken.expires_at.is_(None) | (models.AuthToken.expires_at <= datetime.utcnow())
+    ).delete(synchronize_session=False)
+    db.commit()
+    return count
+
+
+# ============ VERSION COUNTERS ============
+
+def bump(name: str) -> int:
+    """Increment a shared counter and return its new value"""
+    with engine.begin() as conn:
+        return conn.execute(text(
+            "INSERT INTO state_versions (name, version) VALUES (:name, 1) "
+            "ON CONFLICT(name) DO UPDATE SET version = version + 1 "
+            "RETURNING version"
+        ), {"name": name}).scalar()
+
+def read_versions(names) -> dict:
+    if not names:
+        return {}
+    table = models.StateVersion.__table__
+    with engine.connect() as conn:
+        rows = conn.execute(table.select().where(table.c.name.in_(list(names)))).fetchall()
+    return {row.name: row.version for row in rows}
+
+
+class VersionWatcher:
+    """Tracks the last version this process has seen for each counter"""
+
+    def __init__(self):
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def note(self, name: str, version: int):
+        """Record a version this process produced itself"""
+        with self._lock:
+            self._seen[name] = max(version, self._seen.get(name, 0))
+
+    def changed(self, names) -> list:
+        """Names whose shared version moved since they were last seen"""
+        versions = read_versions(names)
+        result = []
+        with self._lock:
+            for name in names:
+                version = versions.get(name, 0)
+                if name in self._seen and version != self._seen[name]:
+                    result.append(name)
+                self._seen[name] = version
+        return result
+
+
+user_signals = VersionWatcher()
+
+def signal_user(user_id: int):
+    """Tell other workers this user's dashboard data changed"""
+    if MULTI_WORKER:
+        user_signals.note(f"user:{user_id}", bump(f"user:{user_id}"))
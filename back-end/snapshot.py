@@ -0,0 +1,193 @@
+"""Online snapshots of the SQLite database, restored on boot.
+
+With SNAPSHOT_ENABLED=1 the database is copied to SNAPSHOT_DIR (put this on a
+mounted disk) every SNAPSHOT_INTERVAL seconds and once more at shutdown.
+Copies use SQLite's backup API a few hundred pages at a time, pausing
+between steps. Under WAL the copy only holds a read snapshot, so writers
+are never blocked. Each snapshot is checked and then renamed into place,
+and the newest SNAPSHOT_KEEP are kept.
+
+On boot, before the server opens the database, the newest snapshot replaces
+the local file if the snapshot is further ahead. Every database carries a
+lineage id, set when it is first initialised, and a generation counter that
+each committed write bumps (`db_meta`). A snapshot is ahead if the local file
+is of another lineage (a freshly built or seeded file) or has a lower
+generation. After an ephemeral host resets to the seeded file, a restart
+therefore recovers all user data with one file copy instead of a reseed.
+
+    python snapshot.py            # take a snapshot now
+    python snapshot.py restore    # restore the newest snapshot if it is ahead
+"""
+import fcntl
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy.engine import make_url
+
+from database import SQLALCHEMY_DATABASE_URL
+
+SNAPSHOT_ENABLED = os.getenv("SNAPSHOT_ENABLED", "0") == "1"
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "./snapshots")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "900"))  # seconds
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "3"))
+SNAPSHOT_PAGES_PER_STEP = int(os.getenv("SNAPSHOT_PAGES_PER_STEP", "256"))
+SNAPSHOT_STEP_SLEEP = float(os.getenv("SNAPSHOT_STEP_SLEEP", "0.01"))  # seconds between steps
+MAX_RESTARTS = 3  # throttled copies restarted by writes before copying in one step
+
+DATABASE_PATH = make_url(SQLALCHEMY_DATABASE_URL).database
+
+
+class SnapshotRestarted(Exception):
+    """A write to the source restarted the throttled copy too many times"""
+
+
+# ============ SNAPSHOT ============
+
+def snapshot_paths() -> list:
+    """Published snapshots, newest first"""
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    names = sorted((f for f in os.listdir(SNAPSHOT_DIR) if f.startswith("sql_app-") and f.endswith(".db")),
+                   reverse=True)
+    return [os.path.join(SNAPSHOT_DIR, name) for name in names]
+
+def _throttled_copy(source, target):
+    restarts = 0
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > MAX_RESTARTS:
+                raise SnapshotRestarted()
+        last_remaining = remaining
+        time.sleep(SNAPSHOT_STEP_SLEEP)
+
+    try:
+        source.backup(target, pages=SNAPSHOT_PAGES_PER_STEP, progress=progress)
+    except (SnapshotRestarted, sqlite3.OperationalError):
+        # Busy writers: copy the rest in one step (still only a read snapshot under WAL)
+        source.backup(target)
+
+def take_snapshot(db_path=DATABASE_PATH) -> str:
+    """Copy the live database into SNAPSHOT_DIR; returns the snapshot path"""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    path = os.path.join(SNAPSHOT_DIR, f"sql_app-{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}.db")
+    tmp_path = path + ".tmp"
+    source = sqlite3.connect(db_path, timeout=5)
+    target = sqlite3.connect(tmp_path)
+    try:
+        _throttled_copy(source, target)
+        # Self-contained file: no -wal/-shm needed to open it
+        target.execute("PRAGMA journal_mode=DELETE")
+        if target.execute("PRAGMA quick_check").fetchone()[0] != "ok":
+            raise sqlite3.DatabaseError("Snapshot failed integrity check")
+    except Exception:
+        target.close()
+        os.remove(tmp_path)
+        raise
+    finally:
+        source.close()
+    target.close()
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    for old in snapshot_paths()[SNAPSHOT_KEEP:]:
+        os.remove(old)
+    return path
+
+
+# ============ RESTORE ============
+
+def generation(path: str):
+    """(lineage, generation) of a database file; lineage is None if missing or not yet initialised"""
+    if not os.path.exists(path):
+        return None, 0
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        row = conn.execute("SELECT lineage, generation FROM db_meta WHERE id = 1").fetchone()
+        return (row[0], row[1]) if row else (None, 0)
+    except sqlite3.DatabaseError:
+        # Written before db_meta existed: only comparable by change-log version
+        try:
+            return None, conn.execute("SELECT COALESCE(MAX(version), 0) FROM change_log").fetchone()[0]
+        except sqlite3.DatabaseError:
+            return None, 0
+    finally:
+        conn.close()
+
+def is_ahead(snapshot_path: str, db_path: str) -> bool:
+    """Whether a snapshot should replace the local database"""
+    snapshot_lineage, snapshot_generation = generation(snapshot_path)
+    local_lineage, local_generation = generation(db_path)
+    if snapshot_lineage is None:
+        # A snapshot from before lineages only beats a local file from before them too
+        return local_lineage is None and snapshot_generation > local_generation
+    return snapshot_lineage != local_lineage or snapshot_generation > local_generation
+
+def restore_latest(db_path=DATABASE_PATH):
+    """Replace the local database with the newest snapshot if that is ahead.
+
+    Must run before anything in this process opens the database. Returns the
+    restored snapshot path, or None.
+    """
+    snapshots = snapshot_paths()
+    if not snapshots or not is_ahead(snapshots[0], db_path):
+        return None
+    tmp_path = db_path + ".restore"
+    shutil.copyfile(snapshots[0], tmp_path)
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    # A stale WAL would be replayed over the restored file
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    os.replace(tmp_path, db_path)
+    return snapshots[0]
+
+
+# ============ SCHEDULER ============
+
+class Snapshotter:
+    """Takes snapshots periodically; a lock file keeps it to one process"""
+
+    def __init__(self, interval=SNAPSHOT_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name="snapshotter", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self):
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        with open(os.path.join(SNAPSHOT_DIR, ".lock"), "w") as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return None  # another worker is snapshotting
+            return take_snapshot()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Snapshot failed: {e}")
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] == ["restore"]:
+        restored = restore_latest()
+        print(f"Restored {restored}" if restored else "Local database is up to date")
+    else:
+        print(f"Snapshot written to {Snapshotter().run_once()}")
@@ -0,0 +1,116 @@
+"""Cold start profiling.
+
+Imported first by main.py to timestamp each startup phase (imports, schema,
+lifespan, deferred warm-up, first request); the report is served at
+`/api/health/startup`. Run directly for a full report from a fresh process:
+
+    python startup_profile.py
+
+which prints the slowest modules from `python -X importtime` and the time
+from spawning uvicorn to its first successful response.
+"""
+import os
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PROCESS_START = time.perf_counter()
+COLD_START_BUDGET = float(os.getenv("COLD_START_BUDGET", "3.0"))  # seconds to first response
+
+_marks = {}
+
+
+def mark(phase: str):
+    """Record seconds since process start for a startup phase (first call wins)"""
+    _marks.setdefault(phase, round(time.perf_counter() - PROCESS_START, 4))
+
+
+def report() -> dict:
+    return {"phases": dict(_marks), "budget": COLD_START_BUDGET}
+
+
+class FirstRequestTimer:
+    """ASGI middleware that marks when the first HTTP request arrives"""
+
+    def __init__(self, app):
+        self.app = app
+        self.seen = False
+
+    async def __call__(self, scope, receive, send):
+        if not self.seen and scope["type"] == "http":
+            self.seen = True
+            mark("first_request")
+        await self.app(scope, receive, send)
+
+
+# ============ OFFLINE REPORT ============
+
+def import_times(module: str = "main", top: int = 15) -> list:
+    """Slowest imports (cumulative microseconds) for a fresh `import module`"""
+    import subprocess
+    import sys
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=BACKEND_DIR, env={**os.environ, "SCHEMA_READY": "1"}
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Only top-level and direct children of the app modules
+        if len(name) - len(name.lstrip()) <= 3:
+            rows.append((name.strip(), int(cumulative)))
+    rows.sort(key=lambda r: r[1], reverse=True)
+    return rows[:top]
+
+
+def measure_cold_start(timeout: float = 30.0) -> float:
+    """Seconds from spawning uvicorn to the first successful response.
+
+    The server runs in a throwaway copy of the backend, so the measurement
+    starts from the committed database and never migrates or litters it.
+    """
+    import shutil
+    import socket
+    import subprocess
+    import sys
+    import tempfile
+    import urllib.request
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    workdir = tempfile.mkdtemp(prefix="cold-start-")
+    shutil.copytree(BACKEND_DIR, workdir, dirs_exist_ok=True, ignore=shutil.ignore_patterns(
+        "__pycache__", "archive", "snapshots", "write_behind.log*", "ratelimit.db*", "*.lock",
+        "sql_app.db-*", "sql_app.db.restore"
+    ))
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/api/health/live", timeout=1) as response:
+                    if response.getcode() == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.02)
+        raise TimeoutError(f"Server did not respond within {timeout}s")
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    print("Slowest imports (ms, cumulative):")
+    for name, micros in import_times():
+        print(f"  {micros / 1000:8.1f}  {name}")
+    elapsed = measure_cold_start()
+    print(f"Time to first response: {elapsed:.2f}s (budget {COLD_START_BUDGET:.2f}s)")
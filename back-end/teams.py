@@ -0,0 +1,177 @@
+"""Team and organisation impact rollups.
+
+`impact_rollups` keeps running totals (CO2 saved and emitted, challenge
+completions, members) for every user, team and organisation. An after_flush
+hook adds each new challenge completion or attributed activity log to the
+user's row and to its team's and organisation's rows in the same
+transaction. A dashboard therefore reads one row per node, and a leaderboard
+is an index scan, whatever the number of members.
+
+Run `python teams.py` to rebuild every rollup from the event tables and
+archives.
+"""
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+import archive
+import models
+
+FIELDS = ("co2_saved", "co2_emitted", "completions", "members")
+
+
+# ============ ROLLUP UPDATES ============
+
+def parents(connection, user_id: int):
+    """(team_id, org_id) for a user, or (None, None) without a team"""
+    row = connection.execute(text(
+        "SELECT t.id, t.org_id FROM team_memberships m JOIN teams t ON t.id = m.team_id "
+        "WHERE m.user_id = :user_id"
+    ), {"user_id": user_id}).first()
+    return (row[0], row[1]) if row else (None, None)
+
+def add(connection, node_type: str, node_id: int, team_id=None, org_id=None, **deltas):
+    """Add deltas to one node's totals, creating the row if needed"""
+    increments = ", ".join(f"{f} = {f} + excluded.{f}" for f in FIELDS)
+    connection.execute(text(
+        f"INSERT INTO impact_rollups (node_type, node_id, team_id, org_id, {', '.join(FIELDS)}) "
+        f"VALUES (:node_type, :node_id, :team_id, :org_id, {', '.join(':' + f for f in FIELDS)}) "
+        f"ON CONFLICT(node_type, node_id) DO UPDATE SET {increments}, "
+        "team_id = excluded.team_id, org_id = excluded.org_id"
+    ), {"node_type": node_type, "node_id": node_id, "team_id": team_id, "org_id": org_id,
+        **{f: deltas.get(f, 0) for f in FIELDS}})
+
+def add_user_event(connection, user_id: int, **deltas):
+    """Add deltas to a user and everything above it"""
+    team_id, org_id = parents(connection, user_id)
+    add(connection, "user", user_id, team_id, org_id, **deltas)
+    if team_id is not None:
+        add(connection, "team", team_id, None, org_id, **deltas)
+        add(connection, "org", org_id, **deltas)
+
+def _user_totals(connection, user_id: int) -> dict:
+    row = connection.execute(text(
+        "SELECT co2_saved, co2_emitted, completions FROM impact_rollups "
+        "WHERE node_type = 'user' AND node_id = :user_id"
+    ), {"user_id": user_id}).first()
+    return dict(zip(("co2_saved", "co2_emitted", "completions"), row or (0, 0, 0)))
+
+def _detach(connection, user_id: int) -> dict:
+    """Take a user's totals out of its current team and organisation"""
+    totals = _user_totals(connection, user_id)
+    team_id, org_id = parents(connection, user_id)
+    if team_id is not None:
+        removed = {f: -v for f, v in totals.items()}
+        add(connection, "team", team_id, None, org_id, members=-1, **removed)
+        add(connection, "org", org_id, members=-1, **removed)
+    return totals
+
+def join_team(db, user_id: int, team: models.Team):
+    """Move a user (and its totals) into a team; the caller commits"""
+    connection = db.connection()
+    totals = _detach(connection, user_id)
+    db.merge(models.TeamMembership(user_id=user_id, team_id=team.id))
+    db.flush()
+    add(connection, "user", user_id, team.id, team.org_id)
+    add(connection, "team", team.id, None, team.org_id, members=1, **totals)
+    add(connection, "org", team.org_id, members=1, **totals)
+
+def leave_team(db, user_id: int):
+    connection = db.connection()
+    _detach(connection, user_id)
+    db.query(models.TeamMembership).filter(models.TeamMembership.user_id == user_id).delete()
+    add(connection, "user", user_id)
+
+@event.listens_for(Session, "after_flush")
+def _roll_up_new_events(session, flush_context):
+    deltas = {}
+    for obj in session.new:
+        if isinstance(obj, models.ChallengeCompletion):
+            d = deltas.setdefault(obj.user_id, {"co2_saved": 0, "co2_emitted": 0, "completions": 0})
+            d["co2_saved"] += obj.co2_saved or 0
+            d["completions"] += 1
+        elif isinstance(obj, models.ActivityLog) and obj.user_id is not None:
+            d = deltas.setdefault(obj.user_id, {"co2_saved": 0, "co2_emitted": 0, "completions": 0})
+            d["co2_emitted"] += obj.co2_impact or 0
+    for user_id, d in deltas.items():
+        add_user_event(session.connection(), user_id, **d)
+
+
+# ============ FULL REBUILD ============
+
+def rebuild(connection) -> int:
+    """Recompute every rollup from the event tables and archives; returns rows written"""
+    users = {}
+
+    def totals(user_id):
+        return users.setdefault(user_id, {"co2_saved": 0.0, "co2_emitted": 0.0, "completions": 0, "members": 0})
+
+    for user_id, saved, count in connection.execute(text(
+        "SELECT user_id, SUM(co2_saved), COUNT(*) FROM challenge_completions GROUP BY user_id"
+    )):
+        t = totals(user_id)
+        t["co2_saved"] += saved or 0
+        t["completions"] += count
+    for user_id, emitted in connection.execute(text(
+        "SELECT user_id, SUM(co2_impact) FROM activity_logs WHERE user_id IS NOT NULL GROUP BY user_id"
+    )):
+        totals(user_id)["co2_emitted"] += emitted or 0
+    for row in archive.archived_rows_desc("challenge_completions"):
+        t = totals(row["user_id"])
+        t["co2_saved"] += row["co2_saved"] or 0
+        t["completions"] += 1
+    for row in archive.archived_rows_desc("activity_logs", lambda r: r.get("user_id") is not None):
+        totals(row["user_id"])["co2_emitted"] += row["co2_impact"] or 0
+
+    membership = {user_id: (team_id, org_id) for user_id, team_id, org_id in connection.execute(text(
+        "SELECT m.user_id, t.id, t.org_id FROM team_memberships m JOIN teams t ON t.id = m.team_id"
+    ))}
+    nodes = {}
+    for user_id in set(users) | set(membership):
+        team_id, org_id = membership.get(user_id, (None, None))
+        t = totals(user_id)
+        nodes[("user", user_id)] = {"team_id": team_id, "org_id": org_id, **t}
+        if team_id is None:
+            continue
+        for key, parent in ((("team", team_id), {"team_id": None, "org_id": org_id}),
+                            (("org", org_id), {"team_id": None, "org_id": None})):
+            node = nodes.setdefault(key, {**parent, "co2_saved": 0.0, "co2_emitted": 0.0, "completions": 0, "members": 0})
+            for f in ("co2_saved", "co2_emitted", "completions"):
+                node[f] += t[f]
+            node["members"] += 1
+    # Teams and organisations without members still get a row
+    for team_id, org_id in connection.execute(text("SELECT id, org_id FROM teams")):
+        nodes.setdefault(("team", team_id), {"team_id": None, "org_id": org_id, "co2_saved": 0.0,
+                                             "co2_emitted": 0.0, "completions": 0, "members": 0})
+    for (org_id,) in connection.execute(text("SELECT id FROM organisations")):
+        nodes.setdefault(("org", org_id), {"team_id": None, "org_id": None, "co2_saved": 0.0,
+                                           "co2_emitted": 0.0, "completions": 0, "members": 0})
+
+    connection.execute(text("DELETE FROM impact_rollups"))
+    if nodes:
+        connection.execute(text(
+            f"INSERT INTO impact_rollups (node_type, node_id, team_id, org_id, {', '.join(FIELDS)}) "
+            f"VALUES (:node_type, :node_id, :team_id, :org_id, {', '.join(':' + f for f in FIELDS)})"
+        ), [{"node_type": t, "node_id": i, **values} for (t, i), values in nodes.items()])
+    return len(nodes)
+
+
+# ============ QUERIES ============
+
+def rollup(db, node_type: str, node_id: int) -> dict:
+    row = db.get(models.ImpactRollup, (node_type, node_id))
+    return {f: getattr(row, f) if row else 0 for f in FIELDS}
+
+def leaderboard(db, node_type: str, parent: str, parent_id: int, limit: int = 10) -> list:
+    """Top nodes of a type under a team or organisation, by CO2 saved"""
+    column = models.ImpactRollup.team_id if parent == "team" else models.ImpactRollup.org_id
+    return db.query(models.ImpactRollup).filter(
+        models.ImpactRollup.node_type == node_type, column == parent_id
+    ).order_by(models.ImpactRollup.co2_saved.desc()).limit(limit).all()
+
+
+if __name__ == "__main__":
+    from database import engine, init_schema
+
+    init_schema()
+    with engine.begin() as conn:
+        print(f"Rebuilt {rebuild(conn)} rollups")
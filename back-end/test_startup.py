@@ -0,0 +1,21 @@
+"""Cold start regression check.
+
+Fails when the time from spawning uvicorn to its first response exceeds
+COLD_START_BUDGET seconds. Only the first boot is timed, since that is what
+a deploy pays (cold caches, schema checks). Run with `python test_startup.py`
+or pytest, from any directory.
+"""
+import sys
+
+from startup_profile import COLD_START_BUDGET, measure_cold_start
+
+
+def test_cold_start_within_budget():
+    elapsed = measure_cold_start()
+    assert elapsed <= COLD_START_BUDGET, f"Cold start took {elapsed:.2f}s (budget {COLD_START_BUDGET:.2f}s)"
+
+
+if __name__ == "__main__":
+    elapsed = measure_cold_start()
+    print(f"Cold start: {elapsed:.2f}s (budget {COLD_START_BUDGET:.2f}s)")
+    sys.exit(0 if elapsed <= COLD_START_BUDGET else 1)
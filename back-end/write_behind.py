@@ -0,0 +1,416 @@
+"""Write-behind queue for challenge completions and food logs.
+
+Enabled with WRITE_BEHIND=1. Endpoints append events to an in-process queue
+(and a local append-only log for crash safety) and return immediately; a
+background worker group-commits batches to the database.
+
+Each process holds an exclusive lock on one log "slot" (write_behind.log,
+write_behind.log.1, ...), so several workers can run side by side and a
+restarted worker picks up and replays whichever slot is free.
+
+Every event carries a key (the log's epoch and the event's sequence number)
+that is stored on the row it inserts. Replaying an event that was committed
+just before a crash is then a no-op. Transient database errors are retried
+with backoff and the events stay in the log until they commit. Only events
+that can never apply (bad data, constraint violations) are dropped.
+"""
+import fcntl
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from sqlalchemy.exc import InterfaceError, OperationalError
+
+import models
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND", "0") == "1"
+FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", "0.05"))  # seconds
+BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "200"))
+MAX_QUEUE = int(os.getenv("WRITE_BEHIND_MAX_QUEUE", "5000"))
+ENQUEUE_TIMEOUT = float(os.getenv("WRITE_BEHIND_ENQUEUE_TIMEOUT", "0.5"))  # seconds
+LOG_PATH = os.getenv("WRITE_BEHIND_LOG", "./write_behind.log")
+MAX_LOG_SLOTS = 64
+FSYNC = os.getenv("WRITE_BEHIND_FSYNC", "1") == "1"
+RETRY_BACKOFF = 0.1  # seconds, doubled after each transient failure
+MAX_RETRY_BACKOFF = 5.0
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)  # locked or unavailable database
+
+
+class QueueFull(Exception):
+    """Raised when the write-behind queue is saturated"""
+
+
+# ============ EVENT APPLICATION ============
+
+def apply_challenge(db, data: dict, write_key=None):
+    """Insert a challenge completion and update the user's current week"""
+    db.add(models.ChallengeCompletion(
+        user_id=data["user_id"],
+        challenge_id=data["challenge_id"],
+        co2_saved=data["co2_saved"],
+        completed_at=datetime.fromisoformat(data["completed_at"]),
+        write_key=write_key
+    ))
+    current_week = db.query(models.UserWeeklyData).filter(
+        models.UserWeeklyData.user_id == data["user_id"]
+    ).order_by(models.UserWeeklyData.id.desc()).first()
+    if current_week:
+        current_week.saved += int(data["co2_saved"])
+
+
+def apply_food(db, data: dict, write_key=None):
+    """Insert a food (or recipe) activity log"""
+    co2_impact, factor_version = data["co2_impact"], data.get("factor_version")
+    food = db.get(models.Food, data["food_id"]) if data["food_id"] is not None and factor_version else None
+    if food is not None and (food.factor_version or 1) != factor_version:
+        # Factor republished while queued; a recompute job may already be past this log
+        co2_impact = round(food.co2_per_100g * data["quantity_grams"] / 100, 2)
+        factor_version = food.factor_version
+    db.add(models.ActivityLog(
+        food_id=data["food_id"],
+        recipe_id=data.get("recipe_id"),
+        user_id=data.get("user_id"),
+        quantity_grams=data["quantity_grams"],
+        co2_impact=co2_impact,
+        factor_version=factor_version,
+        logged_at=data["logged_at"],
+        write_key=write_key
+    ))
+
+
+APPLIERS = {
+    "challenge": apply_challenge,
+    "food": apply_food,
+}
+
+
+def apply_events(db, events):
+    """Apply events, skipping any whose row is already committed (replayed after a crash)"""
+    keys = [e["key"] for e in events if e.get("key")]
+    applied = set()
+    if keys:
+        for model in (models.ChallengeCompletion, models.ActivityLog):
+            applied.update(k for (k,) in db.query(model.write_key).filter(model.write_key.in_(keys)))
+    for event in events:
+        if event.get("key") not in applied:
+            APPLIERS[event["kind"]](db, event["data"], event.get("key"))
+
+
+# ============ QUEUE ============
+
+class WriteBehindQueue:
+    def __init__(self, enabled=WRITE_BEHIND_ENABLED, log_path=LOG_PATH,
+                 flush_interval=FLUSH_INTERVAL, batch_size=BATCH_SIZE,
+                 max_queue=MAX_QUEUE, enqueue_timeout=ENQUEUE_TIMEOUT, fsync=FSYNC):
+        self.enabled = enabled
+        self.base_log_path = log_path
+        self.log_path = log_path
+        self.checkpoint_path = log_path + ".checkpoint"
+        self.max_queue = max_queue
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.enqueue_timeout = enqueue_timeout
+        self.fsync = fsync
+
+        self._queue = queue.Queue()
+        self._slots = threading.BoundedSemaphore(max_queue)  # backpressure on uncommitted events
+        self._log_lock = threading.Lock()
+        self._log = None
+        self._epoch = None  # identifies this log's sequence numbers in write keys
+        self._seq = 0
+
+        # Pending (uncommitted) events, used for read-your-writes
+        self._cond = threading.Condition()
+        self._pending = {}  # user_id -> count
+        self._pending_total = 0
+        self._pending_challenges = set()  # (user_id, challenge_id, date)
+
+        self._flush_now = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._listeners = []
+
+    # ---- lifecycle ----
+
+    def start(self):
+        """Replay the local log and start the background worker"""
+        if self._thread:
+            return
+        self._log = self._claim_log()
+        self._replay()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """Drain the queue and stop the worker"""
+        if not self._thread:
+            return
+        self._stop.set()
+        self._flush_now.set()
+        self._thread.join(timeout)
+        self._thread = None
+        with self._log_lock:
+            if self._log:
+                self._log.close()
+                self._log = None
+
+    def add_listener(self, callback):
+        """Register callback(events) called after each committed batch"""
+        self._listeners.append(callback)
+
+    # ---- producers ----
+
+    def submit(self, kind: str, data: dict, user_id=None):
+        """Durably log an event and queue it for the worker"""
+        if not self._slots.acquire(timeout=self.enqueue_timeout):
+            raise QueueFull("Write-behind queue is full")
+        with self._log_lock:
+            self._seq += 1
+            event = {"seq": self._seq, "key": f"{self._epoch}:{self._seq}", "kind": kind,
+                     "user_id": user_id, "data": data}
+            self._log.write(json.dumps(event) + "\n")
+            self._log.flush()
+            if self.fsync:
+                os.fsync(self._log.fileno())
+            self._track(event)  # under the log lock so truncation can't drop it
+            # Queue in seq order: checkpoints assume a batch's max seq covers every earlier event
+            self._queue.put(event)
+        return event
+
+    def submit_challenge(self, user_id: int, challenge_id: int, co2_saved: float):
+        return self.submit("challenge", {
+            "user_id": user_id,
+            "challenge_id": challenge_id,
+            "co2_saved": co2_saved,
+            "completed_at": datetime.utcnow().isoformat()
+        }, user_id=user_id)
+
+    def submit_food(self, food_id, quantity_grams: float, co2_impact: float, logged_at: str,
+                    recipe_id=None, user_id=None, factor_version=None):
+        return self.submit("food", {
+            "food_id": food_id,
+            "recipe_id": recipe_id,
+            "user_id": user_id,
+            "quantity_grams": quantity_grams,
+            "co2_impact": co2_impact,
+            "factor_version": factor_version,
+            "logged_at": logged_at
+        }, user_id=user_id)
+
+    # ---- read-your-writes ----
+
+    def has_pending_challenge(self, user_id: int, challenge_id: int, day) -> bool:
+        with self._cond:
+            return (user_id, challenge_id, day.isoformat()) in self._pending_challenges
+
+    def sync_user(self, user_id, timeout: float = 2.0) -> bool:
+        """Block until the user's queued writes are committed"""
+        if not self.enabled:
+            return True
+        with self._cond:
+            if not self._pending.get(user_id):
+                return True
+            self._flush_now.set()
+            return self._cond.wait_for(lambda: not self._pending.get(user_id), timeout)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"enabled": self.enabled, "queued": self._queue.qsize(), "pending": self._pending_total}
+
+    def _track(self, event):
+        with self._cond:
+            user_id = event["user_id"]
+            self._pending[user_id] = self._pending.get(user_id, 0) + 1
+            self._pending_total += 1
+            if event["kind"] == "challenge":
+                self._pending_challenges.add(self._challenge_key(event))
+
+    def _untrack(self, batch):
+        with self._cond:
+            for event in batch:
+                user_id = event["user_id"]
+                self._pending[user_id] -= 1
+                if not self._pending[user_id]:
+                    del self._pending[user_id]
+                self._pending_total -= 1
+                if event["kind"] == "challenge":
+                    self._pending_challenges.discard(self._challenge_key(event))
+            self._cond.notify_all()
+
+    @staticmethod
+    def _challenge_key(event):
+        data = event["data"]
+        return (data["user_id"], data["challenge_id"], data["completed_at"][:10])
+
+    # ---- worker ----
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            if batch and not self._commit(batch):
+                return  # stopped while the database was unavailable; the log replays on next start
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            if self._flush_now.is_set():
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=min(remaining, 0.01)))
+            except queue.Empty:
+                pass
+        self._flush_now.clear()
+        return batch
+
+    def _transact(self, events) -> bool:
+        """Apply and commit events, retrying transient errors with backoff.
+
+        Returns False if the queue is stopped before they commit; any other
+        error is raised.
+        """
+        delay = RETRY_BACKOFF
+        while True:
+            db = SessionLocal()
+            try:
+                apply_events(db, events)
+                db.commit()
+                return True
+            except TRANSIENT_ERRORS:
+                db.rollback()
+                logger.warning("Write-behind commit failed, retrying in %.1fs", delay, exc_info=True)
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+            if self._stop.wait(delay):
+                return False
+            delay = min(delay * 2, MAX_RETRY_BACKOFF)
+
+    def _commit(self, batch) -> bool:
+        """Commit a batch and advance the checkpoint; False if stopped first"""
+        committed = batch
+        try:
+            if not self._transact(batch):
+                return False
+        except Exception:
+            # Fall back to one commit per event so a bad event can't sink the batch
+            logger.exception("Write-behind batch failed, retrying events individually")
+            committed = []
+            for event in batch:
+                try:
+                    if not self._transact([event]):
+                        return False
+                    committed.append(event)
+                except Exception:
+                    logger.exception("Dropping write-behind event %s", event["seq"])
+
+        self._write_checkpoint(max(e["seq"] for e in batch))
+        for event in batch:
+            if event.get("_slot", True):
+                self._slots.release()
+        self._untrack(batch)
+        for callback in self._listeners:
+            try:
+                callback(committed)
+            except Exception:
+                logger.exception("Write-behind listener failed")
+        self._truncate_if_drained()
+        return True
+
+    # ---- durable log ----
+
+    def _claim_log(self):
+        """Open and exclusively lock the first free log slot"""
+        for slot in range(MAX_LOG_SLOTS):
+            path = self.base_log_path if slot == 0 else f"{self.base_log_path}.{slot}"
+            f = open(path, "a", encoding="utf-8")
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            self.log_path = path
+            self.checkpoint_path = path + ".checkpoint"
+            return f
+        raise RuntimeError(f"No free write-behind log slot for {self.base_log_path}")
+
+    def _write_checkpoint(self, seq: int):
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(f"{self._epoch} {seq}")
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _read_checkpoint(self):
+        """(epoch, seq) of the last committed event, or (None, 0)"""
+        try:
+            with open(self.checkpoint_path) as f:
+                parts = f.read().split()
+            if len(parts) == 1:
+                return None, int(parts[0])  # written before epochs
+            epoch, seq = parts
+            return epoch, int(seq)
+        except (FileNotFoundError, ValueError):
+            return None, 0
+
+    def _truncate_if_drained(self):
+        """Every logged event is committed once nothing is pending"""
+        with self._log_lock:
+            with self._cond:
+                if self._pending_total or not self._log:
+                    return
+            self._log.truncate(0)
+            self._log.seek(0)
+
+    def _replay(self):
+        """Re-queue events that were logged but not committed before a crash"""
+        self._epoch, checkpoint = self._read_checkpoint()
+        if self._epoch is None:
+            # New log: a fresh epoch keeps its keys apart from any earlier log's
+            self._epoch = uuid.uuid4().hex
+            self._write_checkpoint(checkpoint)
+        self._seq = checkpoint
+        if not os.path.exists(self.log_path):
+            return
+        replayed = 0
+        with open(self.log_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    break  # torn final write
+                self._seq = max(self._seq, event["seq"])
+                if event["seq"] <= checkpoint:
+                    continue
+                event["_slot"] = self._slots.acquire(blocking=False)
+                self._track(event)
+                self._queue.put(event)
+                replayed += 1
+        if replayed:
+            logger.info("Replaying %d write-behind events from %s", replayed, self.log_path)
+
+
+write_queue = WriteBehindQueue()
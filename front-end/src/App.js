@@ -1,5 +1,5 @@
 import React, { useState, useEffect, useMemo } from 'react';
-import { fetchDashboardSummary, fetchDashboardChart, fetchBadges, fetchMonthlyGoal, fetchDashboardDetails } from './services/api';
+import { fetchDashboardSummary, fetchDashboardChart, fetchBadges, fetchMonthlyGoal, fetchDashboardDetails, subscribeToUserStream } from './services/api';
 import { LineChart, Line, BarChart, Bar, XAxis, YAxis, CartesianGrid, Tooltip, Legend, ResponsiveContainer, Area, AreaChart } from 'recharts';
 import { TrendingDown, Award, Flame, Leaf, Calendar, LayoutDashboard, CheckCircle, Droplets, Mountain, ArrowRight, Star, Trophy, Zap, Target, LogOut, User, ChevronLeft, ChevronRight } from 'lucide-react';
 import LoginPage from './pages/LoginPage';
@@ -148,6 +148,15 @@ const ImpactDashboard = ({ user, token, onLogout }) => {
     loadData();
   }, []);
 
+  // Apply live deltas pushed by the backend instead of re-fetching the dashboard
+  useEffect(() => {
+    if (!token) return undefined;
+    return subscribeToUserStream(token, {
+      summary: (summary) => setSummaryData(summary),
+      chart: (week) => setChartData((prev) => prev.map((w) => (w.week === week.week ? week : w)))
+    });
+  }, [token]);
+
   // ============ ALL DYNAMIC CALCULATIONS ============
   
   // Calculate total CO2 saved from chart data
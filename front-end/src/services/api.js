@@ -65,3 +65,16 @@ export const fetchDashboardDetails = async () => {
         throw error;
     }
 };
+
+// Live dashboard updates over server-sent events.
+// handlers: { summary, chart, activity, challenge_completed, resync } -> callback(data)
+export const subscribeToUserStream = (token, handlers) => {
+    const source = new EventSource(`${API_URL}/user/stream?token=${encodeURIComponent(token)}`);
+    Object.entries(handlers).forEach(([type, handler]) => {
+        source.addEventListener(type, (event) => handler(JSON.parse(event.data)));
+    });
+    source.onerror = (error) => {
+        console.error('Live update stream error:', error);
+    };
+    return () => source.close();
+};